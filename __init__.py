@@ -1,101 +1,66 @@
-import sys
-import time
+import argparse
+from typing import List
 
-import cv2
 import ntcore
 
-from calibration.CalibrationCommandSource import (
-    CalibrationCommandSource,
-    NTCalibrationCommandSource,
-)
-from calibration.CalibrationSession import CalibrationSession
 from config.config import ConfigStore, LocalConfig, RemoteConfig
-from config.ConfigSource import ConfigSource, FileConfigSource, NTConfigSource
-from output.OutputPublisher import NTOutputPublisher, OutputPublisher
-from output.overlay_util import overlay_image_observation
-from output.StreamServer import MjpegServer
-from pipeline.CameraPoseEstimator import MultiTargetCameraPoseEstimator
-from pipeline.FiducialPoseEstimator import SquareTargetPoseEstimator
-from pipeline.Capture import GStreamerCapture
-from pipeline.FiducialDetector import ArucoFiducialDetector
+from config.ConfigSource import FileConfigSource, load_camera_config_sources
+from pipeline.CameraPipeline import CameraPipeline, run_pipelines
+from pipeline.Capture import (
+    Capture,
+    GStreamerCapture,
+    ReplayCapture,
+    ThreadedCapture,
+)
 
 
 if __name__ == "__main__":
-    config = ConfigStore(LocalConfig(), RemoteConfig())
-    local_config_source: ConfigSource = FileConfigSource()
-    remote_config_source: ConfigSource = NTConfigSource()
-    calibration_command_source: CalibrationCommandSource = NTCalibrationCommandSource()
-
-    capture = GStreamerCapture()
-    fiducial_detector = ArucoFiducialDetector(cv2.aruco.DICT_APRILTAG_36H11)
-    camera_pose_estimator = MultiTargetCameraPoseEstimator()
-    fiducial_pose_estimator = SquareTargetPoseEstimator()
-    output_publisher: OutputPublisher = NTOutputPublisher()
-    stream_server = MjpegServer()
-    calibration_session = CalibrationSession()
-
-    local_config_source.update(config)
-    ntcore.NetworkTableInstance.getDefault().setServer(config.local_config.server_ip)
-    ntcore.NetworkTableInstance.getDefault().startClient4(config.local_config.device_id)
-    stream_server.start(config)
-
-    frame_count = 0
-    last_print = 0
-    was_calibrating = False
-    while True:
-        try:
-            remote_config_source.update(config)
-            timestamp = time.time()
-            success, image = capture.get_frame(config)
-            if not success:
-                time.sleep(0.5)
-                continue
-
-            fps = None
-            frame_count += 1
-            if time.time() - last_print > 1:
-                last_print = time.time()
-                fps = frame_count
-                print("Running at", frame_count, "fps")
-                frame_count = 0
-
-            if calibration_command_source.get_calibrating(config):
-                # Calibration mode
-                was_calibrating = True
-                calibration_session.process_frame(
-                    image, calibration_command_source.get_capture_flag(config)
-                )
+    parser = argparse.ArgumentParser(description="Northstar AprilTag tracking")
+    parser.add_argument("--config", default=FileConfigSource.CONFIG_FILENAME)
+    parser.add_argument("--calibration", default=FileConfigSource.CALIBRATION_FILENAME)
+    parser.add_argument(
+        "--replay", help="Video file or image directory to read instead of the camera"
+    )
+    parser.add_argument(
+        "--replay-rate",
+        type=float,
+        default=None,
+        help="Replay frames per second, 0 for unpaced (default: recorded timing)",
+    )
+    parser.add_argument("--replay-loop", action="store_true")
+    args = parser.parse_args()
 
-            elif was_calibrating:
-                # Finish calibration
-                calibration_session.finish()
-                sys.exit(1)
+    # One pipeline per camera listed in the config file
+    pipelines: List[CameraPipeline] = []
+    config_sources = load_camera_config_sources(args.config, args.calibration)
+    if args.replay is not None and len(config_sources) > 1:
+        parser.error("--replay only supports a single camera")
+    for config_source in config_sources:
+        config = config_source.update(ConfigStore(LocalConfig(), RemoteConfig()))
+        capture: Capture = GStreamerCapture()
+        if args.replay is not None:
+            capture = ReplayCapture(args.replay, args.replay_rate, args.replay_loop)
+        if config.local_config.threaded_capture or len(config_sources) > 1:
+            # Cameras capture on their own threads, processing is shared
+            capture = ThreadedCapture(capture)
+        pipelines.append(
+            CameraPipeline(config, capture, config_source.calibration_filename)
+        )
 
-            elif config.local_config.has_calibration:
-                # Normal mode
-                try:
-                    image_observations = fiducial_detector.detect_fiducials(
-                        image, config
-                    )
-                    [overlay_image_observation(image, x) for x in image_observations]
-                    pose_observation = camera_pose_estimator.solve_camera_pose(
-                        image_observations, config
-                    )
-                    if pose_observation is not None:
-                        for pose in pose_observation:
-                            output_publisher.send(config, timestamp, pose, fps)
-                except Exception as e:
-                    print(e)
-                    output_publisher.error(str(e))
-                    time.sleep(0.5)
-            else:
-                # No calibration
-                print("No calibration found")
-                time.sleep(0.5)
+    # All cameras share one NetworkTables client
+    ntcore.NetworkTableInstance.getDefault().setServer(
+        pipelines[0].config.local_config.server_ip
+    )
+    ntcore.NetworkTableInstance.getDefault().startClient4(
+        "_".join(pipeline.config.local_config.device_id for pipeline in pipelines)
+    )
+    for pipeline in pipelines:
+        pipeline.start()
 
-            stream_server.set_frame(image)
-        except KeyboardInterrupt:
-            print("Interrupted")
-            break
+    try:
+        run_pipelines(pipelines)
+    except KeyboardInterrupt:
+        print("Interrupted")
 
-    capture.stop()
+    for pipeline in pipelines:
+        pipeline.stop()
@@ -9,11 +9,16 @@ from config.ConfigSource import FileConfigSource
 
 
 class CalibrationSession:
-    _all_charuco_corners: List[numpy.ndarray] = []
-    _all_charuco_ids: List[numpy.ndarray] = []
+    _all_charuco_corners: List[numpy.ndarray]
+    _all_charuco_ids: List[numpy.ndarray]
     _imsize = None
 
-    def __init__(self) -> None:
+    def __init__(
+        self, calibration_filename: str = FileConfigSource.CALIBRATION_FILENAME
+    ) -> None:
+        self._calibration_filename = calibration_filename
+        self._all_charuco_corners = []
+        self._all_charuco_ids = []
         self._aruco_dict = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_5X5_1000)
         self._aruco_params = cv2.aruco.DetectorParameters()
         self._charuco_board = cv2.aruco.CharucoBoard(
@@ -56,8 +61,8 @@ class CalibrationSession:
             print("ERROR: No calibration data")
             return
 
-        if os.path.exists(FileConfigSource.CALIBRATION_FILENAME):
-            os.remove(FileConfigSource.CALIBRATION_FILENAME)
+        if os.path.exists(self._calibration_filename):
+            os.remove(self._calibration_filename)
 
         (
             retval,
@@ -76,7 +81,7 @@ class CalibrationSession:
 
         if retval:
             calibration_store = cv2.FileStorage(
-                FileConfigSource.CALIBRATION_FILENAME, cv2.FILE_STORAGE_WRITE
+                self._calibration_filename, cv2.FILE_STORAGE_WRITE
             )
             calibration_store.write("calibration_date", str(datetime.datetime.now()))
             calibration_store.write("camera_resolution", self._imsize)
@@ -1,14 +1,17 @@
+import dataclasses
 import json
+from typing import List, Union
 
 import cv2
 import ntcore
 import numpy
 
-from config.config import ConfigStore, RemoteConfig
+from config.config import ConfigStore, LocalConfig, RemoteConfig
 
 
 class ConfigSource:
-    def update(self, config_store: ConfigStore) -> None:
+    def update(self, config_store: ConfigStore) -> ConfigStore:
+        """Return a new snapshot if the config has changed, else config_store."""
         raise NotImplementedError
 
 
@@ -16,21 +19,81 @@ class FileConfigSource(ConfigSource):
     CONFIG_FILENAME = "/config/config.json"
     CALIBRATION_FILENAME = "/config/calibration.json"
 
-    def __init__(self) -> None:
-        pass
+    def __init__(
+        self,
+        config_filename: str = CONFIG_FILENAME,
+        calibration_filename: str = CALIBRATION_FILENAME,
+        camera_index: Union[int, None] = None,
+    ) -> None:
+        self._config_filename = config_filename
+        self._default_calibration_filename = calibration_filename
+        self._camera_index = camera_index
+        self.calibration_filename = calibration_filename
 
-    def update(self, config_store: ConfigStore) -> None:
+    def update(self, config_store: ConfigStore) -> ConfigStore:
         # Get config
-        with open(self.CONFIG_FILENAME, "r") as config_file:
+        with open(self._config_filename, "r") as config_file:
             config_data = json.loads(config_file.read())
-            config_store.local_config.camera = config_data["camera"]
-            config_store.local_config.device_id = config_data["device_id"]
-            config_store.local_config.server_ip = config_data["server_ip"]
-            config_store.local_config.stream_port = config_data["stream_port"]
+            if self._camera_index is not None:
+                # In multi-camera mode each camera's settings override the
+                # shared ones, and stream ports count up from the shared port
+                config_data = {
+                    **config_data,
+                    "stream_port": config_data.get(
+                        "stream_port", LocalConfig.stream_port
+                    )
+                    + self._camera_index,
+                    **config_data["cameras"][self._camera_index],
+                }
+            self.calibration_filename = config_data.get(
+                "calibration", self._default_calibration_filename
+            )
+            local_config = dataclasses.replace(
+                config_store.local_config,
+                camera=config_data["camera"],
+                device_id=config_data["device_id"],
+                server_ip=config_data["server_ip"],
+                stream_port=config_data["stream_port"],
+                stream_max_fps=config_data.get(
+                    "stream_max_fps", LocalConfig.stream_max_fps
+                ),
+                stream_scale=config_data.get("stream_scale", LocalConfig.stream_scale),
+                stream_jpeg_quality=config_data.get(
+                    "stream_jpeg_quality", LocalConfig.stream_jpeg_quality
+                ),
+                threaded_capture=config_data.get(
+                    "threaded_capture", LocalConfig.threaded_capture
+                ),
+                grayscale_capture=config_data.get(
+                    "grayscale_capture", LocalConfig.grayscale_capture
+                ),
+                jpeg_decode_scale=config_data.get(
+                    "jpeg_decode_scale", LocalConfig.jpeg_decode_scale
+                ),
+                tracking_full_scan_interval=config_data.get(
+                    "tracking_full_scan_interval",
+                    LocalConfig.tracking_full_scan_interval,
+                ),
+                detection_decimation=config_data.get(
+                    "detection_decimation", LocalConfig.detection_decimation
+                ),
+                detection_tiles=config_data.get(
+                    "detection_tiles", LocalConfig.detection_tiles
+                ),
+                detection_tile_overlap=config_data.get(
+                    "detection_tile_overlap", LocalConfig.detection_tile_overlap
+                ),
+                pose_warm_start=config_data.get(
+                    "pose_warm_start", LocalConfig.pose_warm_start
+                ),
+                binary_output=config_data.get(
+                    "binary_output", LocalConfig.binary_output
+                ),
+            )
 
         # Get calibration
         calibration_store = cv2.FileStorage(
-            self.CALIBRATION_FILENAME, cv2.FILE_STORAGE_READ
+            self.calibration_filename, cv2.FILE_STORAGE_READ
         )
         camera_matrix = calibration_store.getNode("camera_matrix").mat()
         distortion_coefficients = calibration_store.getNode(
@@ -41,9 +104,32 @@ class FileConfigSource(ConfigSource):
             type(camera_matrix) is numpy.ndarray
             and type(distortion_coefficients) is numpy.ndarray
         ):
-            config_store.local_config.camera_matrix = camera_matrix
-            config_store.local_config.distortion_coefficients = distortion_coefficients
-            config_store.local_config.has_calibration = True
+            local_config = dataclasses.replace(
+                local_config,
+                camera_matrix=camera_matrix,
+                distortion_coefficients=distortion_coefficients,
+                has_calibration=True,
+            )
+
+        return dataclasses.replace(
+            config_store, local_config=local_config, version=config_store.version + 1
+        )
+
+
+def load_camera_config_sources(
+    config_filename: str = FileConfigSource.CONFIG_FILENAME,
+    calibration_filename: str = FileConfigSource.CALIBRATION_FILENAME,
+) -> List[FileConfigSource]:
+    """Return a config source for each camera in the "cameras" list of the
+    config file, or a single source if it describes one camera."""
+    with open(config_filename, "r") as config_file:
+        config_data = json.loads(config_file.read())
+    if "cameras" not in config_data:
+        return [FileConfigSource(config_filename, calibration_filename)]
+    return [
+        FileConfigSource(config_filename, calibration_filename, i)
+        for i in range(len(config_data["cameras"]))
+    ]
 
 
 class NTConfigSource(ConfigSource):
@@ -54,9 +140,10 @@ class NTConfigSource(ConfigSource):
     _camera_exposure_sub: ntcore.IntegerSubscriber
     _camera_gain_sub: ntcore.IntegerSubscriber
     _fiducial_size_m_sub: ntcore.DoubleSubscriber
-    _tag_layout_sub: ntcore.DoubleSubscriber
+    _tag_layout_sub: ntcore.StringSubscriber
+    _detector_profile_sub: ntcore.StringSubscriber
 
-    def update(self, config_store: ConfigStore) -> None:
+    def update(self, config_store: ConfigStore) -> ConfigStore:
         # Initialize subscribers on first call
         if not self._init_complete:
             nt_table = ntcore.NetworkTableInstance.getDefault().getTable(
@@ -80,29 +167,43 @@ class NTConfigSource(ConfigSource):
             self._fiducial_size_m_sub = nt_table.getDoubleTopic(
                 "fiducial_size_m"
             ).subscribe(RemoteConfig.fiducial_size_m)
-            self._tag_layout_sub = nt_table.getStringTopic(
-                "tag_layout"
-                ).subscribe("")
+            self._tag_layout_sub = nt_table.getStringTopic("tag_layout").subscribe("")
+            self._detector_profile_sub = nt_table.getStringTopic(
+                "detector_profile"
+            ).subscribe(RemoteConfig.detector_profile)
             self._init_complete = True
 
-        # Read config data
-        config_store.remote_config.camera_resolution_width = (
-            self._camera_resolution_width_sub.get()
-        )
-        config_store.remote_config.camera_resolution_height = (
-            self._camera_resolution_height_sub.get()
-        )
-        config_store.remote_config.camera_auto_exposure = (
-            self._camera_auto_exposure_sub.get()
+        # Read only the values that changed since the last update
+        changes = {}
+        for name, subscriber in [
+            ("camera_resolution_width", self._camera_resolution_width_sub),
+            ("camera_resolution_height", self._camera_resolution_height_sub),
+            ("camera_auto_exposure", self._camera_auto_exposure_sub),
+            ("camera_exposure", self._camera_exposure_sub),
+            ("camera_gain", self._camera_gain_sub),
+            ("fiducial_size_m", self._fiducial_size_m_sub),
+            ("detector_profile", self._detector_profile_sub),
+        ]:
+            values = subscriber.readQueue()
+            if len(values) > 0 and values[-1].value != getattr(
+                config_store.remote_config, name
+            ):
+                changes[name] = values[-1].value
+
+        tag_layouts = self._tag_layout_sub.readQueue()
+        if len(tag_layouts) > 0:
+            tag_layout = None
+            if len(tag_layouts[-1].value) > 0:
+                try:
+                    tag_layout = json.loads(tag_layouts[-1].value)
+                except Exception:
+                    print("Could not deserialize tag layout")
+            changes["tag_layout"] = tag_layout
+
+        if len(changes) == 0:
+            return config_store
+        return dataclasses.replace(
+            config_store,
+            remote_config=dataclasses.replace(config_store.remote_config, **changes),
+            version=config_store.version + 1,
         )
-        config_store.remote_config.camera_exposure = self._camera_exposure_sub.get()
-        config_store.remote_config.camera_gain = self._camera_gain_sub.get()
-        config_store.remote_config.fiducial_size_m = self._fiducial_size_m_sub.get()
-        try:
-            config_store.remote_config.tag_layout = json.loads(
-                self._tag_layout_sub.get()
-            )
-        except Exception:
-            config_store.remote_config.tag_layout = None
-            print("Could not deserialize tag layout")
-            pass
@@ -3,12 +3,25 @@ import numpy
 import numpy.typing
 
 
-@dataclass
+@dataclass(frozen=True)
 class LocalConfig:
     camera_id: int = -1
+    camera: str = ""
     device_id: str = ""
     server_ip: str = ""
     stream_port: int = 8000
+    stream_max_fps: int = 15
+    stream_scale: int = 2
+    stream_jpeg_quality: int = 75
+    threaded_capture: bool = False
+    grayscale_capture: bool = False
+    jpeg_decode_scale: int = 1
+    tracking_full_scan_interval: int = 0
+    detection_decimation: int = 1
+    detection_tiles: int = 1
+    detection_tile_overlap: int = 160
+    pose_warm_start: bool = False
+    binary_output: bool = False
     has_calibration: bool = False
     camera_matrix: numpy.typing.NDArray[numpy.float64] = field(
         default_factory=lambda: numpy.array([])
@@ -18,7 +31,7 @@ class LocalConfig:
     )
 
 
-@dataclass
+@dataclass(frozen=True)
 class RemoteConfig:
     camera_resolution_width: int = 1280
     camera_resolution_height: int = 720
@@ -26,10 +39,18 @@ class RemoteConfig:
     camera_exposure: int = 0
     camera_gain: int = 0
     fiducial_size_m: float = 0.1524
+    detector_profile: str = "default"
     tag_layout: any = None
 
 
-@dataclass
+@dataclass(frozen=True)
 class ConfigStore:
+    """Immutable snapshot of the config.
+
+    Config sources return a new snapshot with a higher version whenever any
+    value changes, so consumers can detect changes by comparing versions.
+    """
+
     local_config: LocalConfig
     remote_config: RemoteConfig
+    version: int = 0
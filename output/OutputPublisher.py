@@ -1,10 +1,32 @@
 import math
-from typing import List, Union
+import struct
+from typing import Dict, List, Tuple, Union
 
 import ntcore
+import numpy
+import numpy.typing
 from config.config import ConfigStore
 from vision_types import PoseObservation
 
+# Binary frame layout (little-endian), published as one raw value per frame:
+#   header: version (u8), observation count (u8), total tag ID count (u16)
+#   one FRAME_OBSERVATION_DTYPE record per observation
+#   tag IDs of every observation in order (u16 each)
+FRAME_FORMAT_VERSION = 1
+FRAME_HEADER = struct.Struct("<BBH")
+FRAME_OBSERVATION_DTYPE = numpy.dtype(
+    [
+        ("pose_count", "<u1"),
+        ("multitag", "<u1"),
+        ("tag_count", "<u2"),
+        # Unused pose slots are zero
+        ("errors", "<f8", (2,)),
+        # (x, y, z, qw, qx, qy, qz) per pose
+        ("poses", "<f8", (2, 7)),
+    ]
+)
+FRAME_TYPE_STRING = "northstar.frame"
+
 
 class OutputPublisher:
     def send(
@@ -16,14 +38,49 @@ class OutputPublisher:
     ) -> None:
         raise NotImplementedError
 
+    def send_frame(
+        self,
+        config_store: ConfigStore,
+        timestamp: float,
+        observations: List[Union[PoseObservation, None]],
+        fps: Union[int, None] = None,
+    ) -> None:
+        """Send all observations from one frame."""
+        for observation in observations:
+            self.send(config_store, timestamp, observation, fps)
+
+    def send_latency(
+        self, config_store: ConfigStore, stats: Dict[str, Tuple[float, float, float]]
+    ) -> None:
+        """Send the p50, p95 and max latency of each stage in milliseconds."""
+        raise NotImplementedError
+
     def error(self, message: str) -> None:
         raise NotImplementedError
 
 
 class NTOutputPublisher(OutputPublisher):
-    _init_complete: bool = False
     _observations_pub: ntcore.DoubleArrayPublisher
+    _frame_pub: ntcore.RawPublisher
     _fps_pub: ntcore.IntegerPublisher
+    _latency_table: ntcore.NetworkTable
+
+    # Initial capacity of the frame buffer, which grows when a frame needs more
+    FRAME_BUFFER_OBSERVATIONS = 16
+    FRAME_BUFFER_TAG_IDS = 64
+    # Initial length of the observations buffer, enough for two poses and
+    # 32 tag IDs
+    OBSERVATION_BUFFER_VALUES = 1 + 2 * 8 + 32
+
+    def __init__(self) -> None:
+        self._init_complete = False
+        self._latency_pubs: Dict[str, List[ntcore.DoublePublisher]] = {}
+        self._frame_buffer = bytearray(
+            FRAME_HEADER.size
+            + self.FRAME_BUFFER_OBSERVATIONS * FRAME_OBSERVATION_DTYPE.itemsize
+            + self.FRAME_BUFFER_TAG_IDS * 2
+        )
+        self._observation_buffer = numpy.zeros(self.OBSERVATION_BUFFER_VALUES)
 
     def send(
         self,
@@ -32,57 +89,133 @@ class NTOutputPublisher(OutputPublisher):
         observation: Union[PoseObservation, None],
         fps: Union[int, None] = None,
     ) -> None:
-        # Initialize publishers on first call
-        if not self._init_complete:
-            nt_table = ntcore.NetworkTableInstance.getDefault().getTable(
-                "/" + config_store.local_config.device_id + "/output"
-            )
-            self._observations_pub = nt_table.getDoubleArrayTopic(
-                "observations"
-            ).publish(
-                ntcore.PubSubOptions(periodic=0, sendAll=True, keepDuplicates=True)
-            )
-            self._fps_pub = nt_table.getIntegerTopic("fps").publish()
+        self._init(config_store)
+        if fps is not None:
+            self._fps_pub.set(fps)
+        self._observations_pub.set(
+            self._pack_observation(observation), math.floor(timestamp * 1000000)
+        )
 
-        # Send data
+    def send_frame(
+        self,
+        config_store: ConfigStore,
+        timestamp: float,
+        observations: List[Union[PoseObservation, None]],
+        fps: Union[int, None] = None,
+    ) -> None:
+        """Send all observations from one frame, as one binary value with
+        binary_output or one observations value per observation otherwise."""
+        self._init(config_store)
         if fps is not None:
             self._fps_pub.set(fps)
-        observation_data: List[float] = [0]
-        if observation is not None:
-            observation_data[0] = 1
-            observation_data.append(observation.error_0)
-            observation_data.append(observation.pose_0.translation().X())
-            observation_data.append(observation.pose_0.translation().Y())
-            observation_data.append(observation.pose_0.translation().Z())
-            observation_data.append(observation.pose_0.rotation().getQuaternion().W())
-            observation_data.append(observation.pose_0.rotation().getQuaternion().X())
-            observation_data.append(observation.pose_0.rotation().getQuaternion().Y())
-            observation_data.append(observation.pose_0.rotation().getQuaternion().Z())
-            if observation.error_1 is not None and observation.pose_1 is not None:
-                observation_data[0] = 2
-                observation_data.append(observation.error_1)
-                observation_data.append(observation.pose_1.translation().X())
-                observation_data.append(observation.pose_1.translation().Y())
-                observation_data.append(observation.pose_1.translation().Z())
-                observation_data.append(
-                    observation.pose_1.rotation().getQuaternion().W()
-                )
-                observation_data.append(
-                    observation.pose_1.rotation().getQuaternion().X()
-                )
-                observation_data.append(
-                    observation.pose_1.rotation().getQuaternion().Y()
-                )
-                observation_data.append(
-                    observation.pose_1.rotation().getQuaternion().Z()
+        nt_timestamp = math.floor(timestamp * 1000000)
+        if config_store.local_config.binary_output:
+            self._frame_pub.set(self._pack_frame(observations), nt_timestamp)
+        else:
+            for observation in observations:
+                self._observations_pub.set(
+                    self._pack_observation(observation), nt_timestamp
                 )
-            for tag_id in observation.tag_ids:
-                observation_data.append(
-                    tag_id
-                )  # We know this will be 1 if [0] is 2 or 2 if [0] is 1
-        self._observations_pub.set(observation_data, math.floor(timestamp * 1000000))
+
+    def send_latency(
+        self, config_store: ConfigStore, stats: Dict[str, Tuple[float, float, float]]
+    ) -> None:
+        self._init(config_store)
+        for stage, values in stats.items():
+            if stage not in self._latency_pubs:
+                stage_table = self._latency_table.getSubTable(stage)
+                self._latency_pubs[stage] = [
+                    stage_table.getDoubleTopic(name).publish()
+                    for name in ("p50", "p95", "max")
+                ]
+            for publisher, value in zip(self._latency_pubs[stage], values):
+                publisher.set(value)
 
     def error(self, message: str) -> None:
         ntcore.NetworkTableInstance.getDefault().getTable("/output").getEntry(
             "error"
         ).setString(message)
+
+    def _init(self, config_store: ConfigStore) -> None:
+        """Initialize publishers on first call."""
+        if self._init_complete:
+            return
+        nt_table = ntcore.NetworkTableInstance.getDefault().getTable(
+            "/" + config_store.local_config.device_id + "/output"
+        )
+        self._observations_pub = nt_table.getDoubleArrayTopic("observations").publish(
+            ntcore.PubSubOptions(periodic=0, sendAll=True, keepDuplicates=True)
+        )
+        if config_store.local_config.binary_output:
+            self._frame_pub = nt_table.getRawTopic("frame").publish(
+                FRAME_TYPE_STRING,
+                ntcore.PubSubOptions(periodic=0, sendAll=True, keepDuplicates=True),
+            )
+        self._fps_pub = nt_table.getIntegerTopic("fps").publish()
+        self._latency_table = nt_table.getSubTable("latency")
+        self._init_complete = True
+
+    def _pack_frame(
+        self, observations: List[Union[PoseObservation, None]]
+    ) -> memoryview:
+        """Pack observations into the reusable frame buffer, skipping failed
+        solves, and return a view of the packed bytes."""
+        observations = [x for x in observations if x is not None]
+        tag_id_count = sum(len(x.tag_ids) for x in observations)
+        records_offset = FRAME_HEADER.size
+        tag_ids_offset = (
+            records_offset + len(observations) * FRAME_OBSERVATION_DTYPE.itemsize
+        )
+        size = tag_ids_offset + tag_id_count * 2
+        if size > len(self._frame_buffer):
+            self._frame_buffer = bytearray(size * 2)
+
+        FRAME_HEADER.pack_into(
+            self._frame_buffer, 0, FRAME_FORMAT_VERSION, len(observations), tag_id_count
+        )
+        records = numpy.frombuffer(
+            self._frame_buffer,
+            dtype=FRAME_OBSERVATION_DTYPE,
+            count=len(observations),
+            offset=records_offset,
+        )
+        tag_ids = numpy.frombuffer(
+            self._frame_buffer, dtype="<u2", count=tag_id_count, offset=tag_ids_offset
+        )
+        tag_index = 0
+        for i, observation in enumerate(observations):
+            pose_count = len(observation.errors)
+            tag_count = len(observation.tag_ids)
+            records["pose_count"][i] = pose_count
+            records["multitag"][i] = observation.multitag
+            records["tag_count"][i] = tag_count
+            records["errors"][i, :pose_count] = observation.errors
+            records["errors"][i, pose_count:] = 0.0
+            records["poses"][i, :pose_count] = observation.poses
+            records["poses"][i, pose_count:] = 0.0
+            tag_ids[tag_index : tag_index + tag_count] = observation.tag_ids
+            tag_index += tag_count
+        return memoryview(self._frame_buffer)[:size]
+
+    def _pack_observation(
+        self, observation: Union[PoseObservation, None]
+    ) -> numpy.typing.NDArray[numpy.float64]:
+        """Pack an observation into the reusable observation buffer and return
+        a view of the packed values.
+
+        Layout: [pose count, (error, x, y, z, qw, qx, qy, qz) per pose, tag IDs]
+        """
+        if observation is None:
+            self._observation_buffer[0] = 0
+            return self._observation_buffer[:1]
+        pose_count = len(observation.errors)
+        size = 1 + pose_count * 8 + len(observation.tag_ids)
+        if size > len(self._observation_buffer):
+            self._observation_buffer = numpy.zeros(size * 2)
+        observation_data = self._observation_buffer[:size]
+        observation_data[0] = pose_count
+        poses_data = observation_data[1 : 1 + pose_count * 8].reshape(-1, 8)
+        poses_data[:, 0] = observation.errors
+        poses_data[:, 1:] = observation.poses
+        observation_data[1 + pose_count * 8 :] = observation.tag_ids
+        return observation_data
@@ -1,13 +1,16 @@
-import socketserver
+import asyncio
+import concurrent.futures
 import threading
 import time
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from io import BytesIO
+import urllib.parse
+from typing import Callable, Dict, List, Set, Tuple, Union
 
 import cv2
-from PIL import Image
+import numpy
 
 from config.config import ConfigStore
+from output.frame_buffer import FrameBuffer
+from output.metrics import format_metric
 
 
 class StreamServer:
@@ -18,17 +21,43 @@ class StreamServer:
         raise NotImplementedError
 
     def set_frame(self, frame: cv2.Mat) -> None:
-        """Sets the frame to serve."""
+        """Sets the frame to serve. The frame must not be modified after it is
+        set."""
+        raise NotImplementedError
+
+    def get_frame_slot(self, shape: Tuple[int, ...], dtype: numpy.dtype) -> cv2.Mat:
+        """Returns an image to draw the next frame into before setting it."""
+        return numpy.empty(shape, dtype)
+
+    def has_clients(self) -> bool:
+        """Returns whether anyone is viewing the stream, so frames only need
+        to be prepared and set while this is true."""
+        raise NotImplementedError
+
+    def set_diagnostics(
+        self,
+        get_metrics: Callable[[], str],
+        request_profile: Callable[[float], Union[concurrent.futures.Future, None]],
+    ) -> None:
+        """Sets the sources of pipeline metrics in Prometheus text format and
+        of profiles of the pipeline for a number of seconds."""
         raise NotImplementedError
 
 
 class MjpegServer(StreamServer):
-    _frame: cv2.Mat
-    _has_frame: bool = False
+    """Serves frames as an MJPEG stream.
+
+    Each frame is encoded once by an encoder thread, at most stream_max_fps
+    times per second and with stream_jpeg_quality. All clients are served by
+    one asyncio event loop on a single thread, so the number of viewers does
+    not add threads competing with the pipeline. Clients that read slower than
+    frames are encoded skip to the newest frame instead of queueing them.
+
+    The same listener serves pipeline and stream metrics at /metrics, and
+    profiles of the pipeline at /profile?seconds=N.
+    """
 
-    def _make_handler(self_mjpeg):  # type: ignore
-        class StreamingHandler(BaseHTTPRequestHandler):
-            HTML = """
+    HTML = """
     <html>
         <head>
             <title>Northstar Debug</title>
@@ -51,66 +80,238 @@ class MjpegServer(StreamServer):
             <img src="stream.mjpg" />
         </body>
     </html>
-            """
-
-            def do_GET(self):
-                if self.path == "/":
-                    content = self.HTML.encode("utf-8")
-                    self.send_response(200)
-                    self.send_header("Content-Type", "text/html")
-                    self.send_header("Content-Length", str(len(content)))
-                    self.end_headers()
-                    self.wfile.write(content)
-                elif self.path == "/stream.mjpg":
-                    self.send_response(200)
-                    self.send_header("Age", "0")
-                    self.send_header("Cache-Control", "no-cache, private")
-                    self.send_header("Pragma", "no-cache")
-                    self.send_header(
-                        "Content-Type", "multipart/x-mixed-replace; boundary=FRAME"
+    """
+
+    # How long /snapshot.jpg waits for the pipeline to produce a frame
+    SNAPSHOT_TIMEOUT_SECS = 2.0
+
+    # Default and maximum length of a profile, and how much longer than its
+    # length to wait for it in case the pipeline is stalled
+    PROFILE_DEFAULT_SECS = 5.0
+    PROFILE_MAX_SECS = 60.0
+    PROFILE_TIMEOUT_MARGIN_SECS = 10.0
+
+    def __init__(self) -> None:
+        # Frames waiting to be encoded
+        self._frame_buffer = FrameBuffer()
+        self._max_fps = 0
+        self._jpeg_quality = 75
+        self._device_id = ""
+        self._get_metrics: Union[Callable[[], str], None] = None
+        self._request_profile: Union[
+            Callable[[float], Union[concurrent.futures.Future, None]], None
+        ] = None
+        # Only used on the event loop thread
+        self._loop: Union[asyncio.AbstractEventLoop, None] = None
+        self._jpeg: bytes = b""
+        self._jpeg_count = 0
+        # One event per connected client, set when a new JPEG is ready
+        self._client_events: Set[asyncio.Event] = set()
+        # Frames not sent to slow stream clients
+        self._skipped_frames = 0
+
+    async def _serve(self, port: int) -> None:
+        self._loop = asyncio.get_running_loop()
+        server = await asyncio.start_server(
+            self._handle_client, port=port, reuse_address=True
+        )
+        async with server:
+            await server.serve_forever()
+
+    async def _handle_client(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            request = await reader.readuntil(b"\r\n\r\n")
+            request_line = request.split(b"\r\n", 1)[0].decode("latin-1").split()
+            if len(request_line) < 2 or request_line[0] != "GET":
+                writer.write(_response("405 Method Not Allowed"))
+                return
+            path, _, query = request_line[1].partition("?")
+            if path == "/":
+                writer.write(_response("200 OK", "text/html", self.HTML.encode()))
+            elif path == "/stream.mjpg":
+                await self._send_stream(writer)
+            elif path == "/snapshot.jpg":
+                await self._send_snapshot(writer)
+            elif path == "/metrics":
+                writer.write(
+                    _response(
+                        "200 OK",
+                        "text/plain; version=0.0.4",
+                        self._format_metrics().encode(),
                     )
-                    self.end_headers()
-                    try:
-                        while True:
-                            if not self_mjpeg._has_frame:
-                                time.sleep(0.1)
-                            else:
-                                pil_im = Image.fromarray(self_mjpeg._frame)
-                                stream = BytesIO()
-                                pil_im.save(stream, format="JPEG")
-                                frame_data = stream.getvalue()
-
-                                self.wfile.write(b"--FRAME\r\n")
-                                self.send_header("Content-Type", "image/jpeg")
-                                self.send_header("Content-Length", str(len(frame_data)))
-                                self.end_headers()
-                                self.wfile.write(frame_data)
-                                self.wfile.write(b"\r\n")
-                    except Exception as e:
-                        print(
-                            "Removed streaming client %s: %s",
-                            self.client_address,
-                            str(e),
-                        )
-                else:
-                    self.send_error(404)
-                    self.end_headers()
-
-        return StreamingHandler
-
-    class StreamingServer(socketserver.ThreadingMixIn, HTTPServer):
-        allow_reuse_address = True
-        daemon_threads = True
+                )
+            elif path == "/profile" and self._request_profile is not None:
+                await self._send_profile(writer, urllib.parse.parse_qs(query))
+            else:
+                writer.write(_response("404 Not Found"))
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            print(
+                "Removed streaming client %s: %s"
+                % (writer.get_extra_info("peername"), e)
+            )
+        except asyncio.LimitOverrunError:
+            writer.write(_response("400 Bad Request"))
+        finally:
+            writer.close()
+
+    async def _send_stream(self, writer: asyncio.StreamWriter) -> None:
+        writer.write(
+            b"HTTP/1.0 200 OK\r\n"
+            + b"Age: 0\r\n"
+            + b"Cache-Control: no-cache, private\r\n"
+            + b"Pragma: no-cache\r\n"
+            + b"Content-Type: multipart/x-mixed-replace; boundary=FRAME\r\n\r\n"
+        )
+        event = asyncio.Event()
+        self._client_events.add(event)
+        jpeg_count = None
+        try:
+            while True:
+                await event.wait()
+                event.clear()
+                if jpeg_count is not None:
+                    self._skipped_frames += self._jpeg_count - jpeg_count - 1
+                jpeg = self._jpeg
+                jpeg_count = self._jpeg_count
+                writer.writelines(
+                    (
+                        b"--FRAME\r\nContent-Type: image/jpeg\r\n"
+                        + b"Content-Length: %d\r\n\r\n" % len(jpeg),
+                        jpeg,
+                        b"\r\n",
+                    )
+                )
+                # Frames encoded while waiting for a slow client are skipped
+                await writer.drain()
+        finally:
+            self._client_events.discard(event)
+
+    async def _send_snapshot(self, writer: asyncio.StreamWriter) -> None:
+        """Send the next frame, which is only produced while someone waits."""
+        event = asyncio.Event()
+        self._client_events.add(event)
+        try:
+            await asyncio.wait_for(event.wait(), self.SNAPSHOT_TIMEOUT_SECS)
+        except asyncio.TimeoutError:
+            writer.write(_response("503 Service Unavailable"))
+            return
+        finally:
+            self._client_events.discard(event)
+        writer.write(_response("200 OK", "image/jpeg", self._jpeg))
+        await writer.drain()
+
+    async def _send_profile(
+        self, writer: asyncio.StreamWriter, query: Dict[str, List[str]]
+    ) -> None:
+        try:
+            seconds = float(query.get("seconds", [self.PROFILE_DEFAULT_SECS])[0])
+        except ValueError:
+            writer.write(_response("400 Bad Request"))
+            return
+        if not 0 < seconds <= self.PROFILE_MAX_SECS:
+            writer.write(_response("400 Bad Request"))
+            return
+        future = self._request_profile(seconds)
+        if future is None:
+            writer.write(_response("409 Conflict", "text/plain", b"Already profiling"))
+            return
+        try:
+            report = await asyncio.wait_for(
+                asyncio.wrap_future(future),
+                seconds + self.PROFILE_TIMEOUT_MARGIN_SECS,
+            )
+        except asyncio.TimeoutError:
+            writer.write(_response("503 Service Unavailable"))
+            return
+        writer.write(_response("200 OK", "text/plain", report.encode()))
+        await writer.drain()
+
+    def _format_metrics(self) -> str:
+        labels = {"device": self._device_id}
+        metrics = "" if self._get_metrics is None else self._get_metrics()
+        return (
+            metrics
+            + format_metric(
+                "northstar_stream_clients",
+                "gauge",
+                "Open stream and snapshot connections.",
+                [("", labels, len(self._client_events))],
+            )
+            + format_metric(
+                "northstar_stream_dropped_frames_total",
+                "counter",
+                "Frames replaced before they were encoded for the stream.",
+                [("", labels, self._frame_buffer.dropped_frames)],
+            )
+            + format_metric(
+                "northstar_stream_skipped_frames_total",
+                "counter",
+                "Encoded frames not sent to slow stream clients.",
+                [("", labels, self._skipped_frames)],
+            )
+        )
+
+    def _publish_jpeg(self, jpeg: bytes) -> None:
+        """Make a new JPEG available to clients, on the event loop thread."""
+        self._jpeg = jpeg
+        self._jpeg_count += 1
+        for event in self._client_events:
+            event.set()
 
     def _run(self, port: int) -> None:
-        server = self.StreamingServer(("", port), self._make_handler())
-        server.serve_forever()
+        asyncio.run(self._serve(port))
+
+    def _run_encoder(self) -> None:
+        last_encode_time = 0.0
+        while True:
+            if self._max_fps > 0:
+                delay = last_encode_time + 1.0 / self._max_fps - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+            # Encode the newest frame, skipping any replaced while waiting
+            frame = self._frame_buffer.take()
+            last_encode_time = time.monotonic()
+            success, jpeg = cv2.imencode(
+                ".jpg", frame, (cv2.IMWRITE_JPEG_QUALITY, self._jpeg_quality)
+            )
+            if success and self._loop is not None:
+                self._loop.call_soon_threadsafe(self._publish_jpeg, jpeg.tobytes())
 
     def start(self, config_store: ConfigStore) -> None:
+        self._max_fps = config_store.local_config.stream_max_fps
+        self._jpeg_quality = config_store.local_config.stream_jpeg_quality
+        self._device_id = config_store.local_config.device_id
+        threading.Thread(target=self._run_encoder, daemon=True).start()
         threading.Thread(
             target=self._run, daemon=True, args=(config_store.local_config.stream_port,)
         ).start()
 
     def set_frame(self, frame: cv2.Mat) -> None:
-        self._frame = frame.copy()
-        self._has_frame = True
+        self._frame_buffer.publish(frame)
+
+    def get_frame_slot(self, shape: Tuple[int, ...], dtype: numpy.dtype) -> cv2.Mat:
+        return self._frame_buffer.get_slot(shape, dtype)
+
+    def has_clients(self) -> bool:
+        return len(self._client_events) > 0
+
+    def set_diagnostics(
+        self,
+        get_metrics: Callable[[], str],
+        request_profile: Callable[[float], Union[concurrent.futures.Future, None]],
+    ) -> None:
+        self._get_metrics = get_metrics
+        self._request_profile = request_profile
+
+
+def _response(status: str, content_type: str = "", content: bytes = b"") -> bytes:
+    """Return a complete HTTP response."""
+    headers = "HTTP/1.0 " + status + "\r\n"
+    if content_type != "":
+        headers += "Content-Type: " + content_type + "\r\n"
+        headers += "Cache-Control: no-cache, private\r\n"
+    headers += "Content-Length: " + str(len(content)) + "\r\n\r\n"
+    return headers.encode("latin-1") + content
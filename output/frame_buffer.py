@@ -0,0 +1,53 @@
+import threading
+from typing import List, Tuple, Union
+
+import cv2
+import numpy
+
+
+class FrameBuffer:
+    """Hands frames from the pipeline to a reader thread without copying.
+
+    The writer draws into a preallocated slot from get_slot, or any frame it
+    will no longer modify, and passes it to publish. The reader takes the
+    newest published frame, which stays reserved until its next take. With
+    three slots the writer always has a free slot that the reader cannot see,
+    and neither side waits for the other.
+    """
+
+    def __init__(self, slot_count: int = 3) -> None:
+        self._condition = threading.Condition()
+        self._slots: List[Union[cv2.Mat, None]] = [None] * slot_count
+        self._latest: Union[cv2.Mat, None] = None
+        self._reading: Union[cv2.Mat, None] = None
+        # Frames replaced before they were taken
+        self.dropped_frames = 0
+
+    def get_slot(self, shape: Tuple[int, ...], dtype: numpy.dtype) -> cv2.Mat:
+        """Return a slot of the given shape that is neither waiting to be read
+        nor being read."""
+        with self._condition:
+            for i, slot in enumerate(self._slots):
+                if slot is not None and (slot is self._latest or slot is self._reading):
+                    continue
+                if slot is None or slot.shape != shape or slot.dtype != dtype:
+                    slot = numpy.empty(shape, dtype)
+                    self._slots[i] = slot
+                return slot
+        raise RuntimeError("No free frame slot")
+
+    def publish(self, frame: cv2.Mat) -> None:
+        """Make frame the newest frame, replacing any that was not read."""
+        with self._condition:
+            if self._latest is not None:
+                self.dropped_frames += 1
+            self._latest = frame
+            self._condition.notify()
+
+    def take(self) -> cv2.Mat:
+        """Wait for and return the newest frame not yet taken."""
+        with self._condition:
+            self._condition.wait_for(lambda: self._latest is not None)
+            self._reading = self._latest
+            self._latest = None
+            return self._reading
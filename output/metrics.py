@@ -0,0 +1,43 @@
+from typing import Dict, List, Tuple, Union
+
+# (name suffix, labels, value) of one sample of a metric
+Sample = Tuple[str, Dict[str, str], Union[int, float]]
+
+
+def format_metric(
+    name: str, metric_type: str, description: str, samples: List[Sample]
+) -> str:
+    """Return a metric in the Prometheus text exposition format."""
+    lines = [
+        "# HELP " + name + " " + description,
+        "# TYPE " + name + " " + metric_type,
+    ]
+    for suffix, labels, value in samples:
+        label_text = ",".join(
+            key + '="' + _escape(label_value) + '"'
+            for key, label_value in labels.items()
+        )
+        lines.append(name + suffix + "{" + label_text + "} " + repr(value))
+    return "\n".join(lines) + "\n"
+
+
+def histogram_samples(
+    labels: Dict[str, str],
+    buckets: Tuple[float, ...],
+    cumulative_counts: List[int],
+    total: float,
+) -> List[Sample]:
+    """Return the samples of a histogram, given the cumulative count of each
+    bucket followed by the count of all observations."""
+    samples: List[Sample] = [
+        ("_bucket", {**labels, "le": repr(bound)}, count)
+        for bound, count in zip(buckets, cumulative_counts)
+    ]
+    samples.append(("_bucket", {**labels, "le": "+Inf"}, cumulative_counts[-1]))
+    samples.append(("_sum", labels, total))
+    samples.append(("_count", labels, cumulative_counts[-1]))
+    return samples
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
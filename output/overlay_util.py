@@ -1,14 +1,25 @@
+from typing import List
+
 import cv2
 import numpy
 from config.config import ConfigStore
 from vision_types import FiducialImageObservation, PoseObservation
 
 
-def overlay_image_observation(
-    image: cv2.Mat, observation: FiducialImageObservation
+def overlay_image_observations(
+    image: cv2.Mat, observations: List[FiducialImageObservation], scale: float = 1.0
 ) -> None:
+    """Draw all observations in one call, with corners scaled by the ratio of
+    the image size to the size they were detected at."""
+    if len(observations) == 0:
+        return
+    corners = numpy.array([x.corners.reshape(1, 4, 2) for x in observations])
+    if scale != 1.0:
+        corners = (corners + 0.5) * scale - 0.5
     cv2.aruco.drawDetectedMarkers(
-        image, numpy.array([observation.corners]), numpy.array([observation.tag_id])
+        image,
+        corners.astype(numpy.float32),
+        numpy.array([x.tag_id for x in observations], dtype=numpy.int32),
     )
 
 
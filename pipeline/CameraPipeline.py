@@ -0,0 +1,303 @@
+import concurrent.futures
+import os
+import sys
+import time
+from typing import Dict, List, Union
+
+import cv2
+
+from calibration.CalibrationCommandSource import (
+    CalibrationCommandSource,
+    NTCalibrationCommandSource,
+)
+from calibration.CalibrationSession import CalibrationSession
+from config.config import ConfigStore
+from config.ConfigSource import ConfigSource, NTConfigSource
+from output.metrics import format_metric, histogram_samples
+from output.OutputPublisher import NTOutputPublisher, OutputPublisher
+from output.overlay_util import overlay_image_observations
+from output.StreamServer import MjpegServer, StreamServer
+from pipeline.CameraPoseEstimator import MultiTargetCameraPoseEstimator
+from pipeline.Capture import Capture
+from pipeline.FiducialDetector import (
+    ArucoFiducialDetector,
+    refine_scaled_observations,
+    scale_observations,
+)
+from pipeline.frame_profiler import FrameProfiler
+from pipeline.stage_timer import HISTOGRAM_BUCKETS, StageTimer
+
+
+class CameraPipeline:
+    """Capture, detection, pose estimation and outputs of one camera.
+
+    Each camera reads its remote config from and publishes to its own
+    device_id table, and serves its own stream.
+    """
+
+    def __init__(
+        self, config_store: ConfigStore, capture: Capture, calibration_filename: str
+    ) -> None:
+        self.config = config_store
+        self.capture = capture
+        self._remote_config_source: ConfigSource = NTConfigSource()
+        self._calibration_command_source: CalibrationCommandSource = (
+            NTCalibrationCommandSource()
+        )
+        self._fiducial_detector = ArucoFiducialDetector(cv2.aruco.DICT_APRILTAG_36H11)
+        self._camera_pose_estimator = MultiTargetCameraPoseEstimator()
+        self._output_publisher: OutputPublisher = NTOutputPublisher()
+        self._stream_server: StreamServer = MjpegServer()
+        self._calibration_session = CalibrationSession(calibration_filename)
+        self._stage_timer = StageTimer()
+        self._profiler = FrameProfiler()
+        self._stream_server.set_diagnostics(self._get_metrics, self._profiler.request)
+        self._processed_frames = 0
+        self._detected_tags = 0
+        self._observations = 0
+        self._frame_count = 0
+        self._last_print = 0.0
+        self._was_calibrating = False
+
+    def start(self) -> None:
+        self._stream_server.start(self.config)
+
+    def stop(self) -> None:
+        self.capture.stop()
+
+    def set_detection_executor(
+        self, executor: Union[concurrent.futures.Executor, None]
+    ) -> None:
+        """Set the worker pool that detection tiles are processed on."""
+        self._fiducial_detector.set_executor(executor)
+
+    def process_frame(self) -> bool:
+        """Read and process one frame. Returns False once the capture has no
+        more frames."""
+        self._profiler.start_frame()
+        try:
+            return self._process_frame()
+        finally:
+            self._profiler.end_frame()
+
+    def _process_frame(self) -> bool:
+        self.config = self._remote_config_source.update(self.config)
+        self._stage_timer.start_frame()
+        success, image, timestamp = self.capture.get_frame(self.config)
+        self._stage_timer.mark("capture")
+        if not success:
+            if self.capture.is_finished():
+                return False
+            time.sleep(0.5)
+            return True
+
+        fps = None
+        self._frame_count += 1
+        if time.time() - self._last_print > 1:
+            self._last_print = time.time()
+            fps = self._frame_count
+            print(self.config.local_config.device_id, "running at", fps, "fps")
+            self._frame_count = 0
+
+        # Only frames processed without errors are timed
+        timed = False
+        # Image to stream, only prepared while the stream has clients
+        preview = None
+
+        if self._calibration_command_source.get_calibrating(self.config):
+            # Calibration mode
+            self._was_calibrating = True
+            full_resolution_loader = self.capture.get_full_resolution_loader()
+            if full_resolution_loader is not None:
+                image = full_resolution_loader()
+            self._calibration_session.process_frame(
+                image, self._calibration_command_source.get_capture_flag(self.config)
+            )
+
+        elif self._was_calibrating:
+            # Finish calibration
+            self._calibration_session.finish()
+            sys.exit(1)
+
+        elif self.config.local_config.has_calibration:
+            # Normal mode
+            try:
+                image_observations = self._fiducial_detector.detect_fiducials(
+                    image, self.config
+                )
+                decode_scale = self.capture.get_decode_scale()
+                if decode_scale > 1 and len(image_observations) > 0:
+                    # Frame was decoded at reduced scale, refine on it rather
+                    # than decoding it again at full resolution. This must
+                    # happen before overlays, which may be drawn on the image.
+                    image_observations = scale_observations(
+                        refine_scaled_observations(image_observations, image, 1),
+                        decode_scale,
+                    )
+                self._stage_timer.mark("detect")
+                self._detected_tags += len(image_observations)
+                if self._stream_server.has_clients():
+                    # Grayscale captures are only converted when drawing overlays
+                    preview = self._make_preview(image, len(image_observations) > 0)
+                    overlay_image_observations(
+                        preview,
+                        image_observations,
+                        preview.shape[1] / (image.shape[1] * decode_scale),
+                    )
+                    self._stage_timer.mark("overlay")
+                pose_observations = self._camera_pose_estimator.solve_camera_pose(
+                    image_observations, self.config
+                )
+                self._stage_timer.mark("solve")
+                self._output_publisher.send_frame(
+                    self.config,
+                    timestamp,
+                    [] if pose_observations is None else pose_observations,
+                    fps,
+                )
+                self._stage_timer.mark("publish")
+                self._processed_frames += 1
+                if pose_observations is not None:
+                    self._observations += sum(x is not None for x in pose_observations)
+                timed = True
+            except Exception as e:
+                print(e)
+                self._output_publisher.error(str(e))
+                time.sleep(0.5)
+        else:
+            # No calibration
+            print("No calibration found for", self.config.local_config.device_id)
+            time.sleep(0.5)
+
+        if self._stream_server.has_clients():
+            if preview is None:
+                preview = self._make_preview(image, False)
+            self._stream_server.set_frame(preview)
+            self._stage_timer.mark("stream")
+        if timed:
+            self._stage_timer.end_frame()
+        if fps is not None:
+            self._output_publisher.send_latency(
+                self.config, self._stage_timer.get_stats()
+            )
+        return True
+
+    def _get_metrics(self) -> str:
+        """Return the pipeline's metrics in Prometheus text format. Called
+        from the stream server's thread."""
+        labels = {"device": self.config.local_config.device_id}
+        stage_samples = []
+        for stage, (counts, total) in self._stage_timer.get_histograms().items():
+            stage_samples += histogram_samples(
+                {**labels, "stage": stage}, HISTOGRAM_BUCKETS, counts, total
+            )
+        return (
+            format_metric(
+                "northstar_stage_seconds",
+                "histogram",
+                "Time spent in each stage of processing a frame.",
+                stage_samples,
+            )
+            + format_metric(
+                "northstar_frames_total",
+                "counter",
+                "Frames processed without errors.",
+                [("", labels, self._processed_frames)],
+            )
+            + format_metric(
+                "northstar_detected_tags_total",
+                "counter",
+                "Tags detected in all frames.",
+                [("", labels, self._detected_tags)],
+            )
+            + format_metric(
+                "northstar_observations_total",
+                "counter",
+                "Pose observations published.",
+                [("", labels, self._observations)],
+            )
+            + format_metric(
+                "northstar_capture_dropped_frames_total",
+                "counter",
+                "Frames read from the camera but replaced before processing.",
+                [("", labels, self.capture.get_dropped_frames())],
+            )
+        )
+
+    def _make_preview(self, image: cv2.Mat, color: bool) -> cv2.Mat:
+        """Return the image shrunk by stream_scale for the stream, converted to
+        BGR if color is set.
+
+        Shrunk frames are written into the stream server's preallocated frame
+        slots. Otherwise the image itself is streamed, so it must not be
+        modified once set.
+        """
+        convert = color and len(image.shape) == 2
+        scale = self.config.local_config.stream_scale
+        if scale <= 1:
+            return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR) if convert else image
+        size = (image.shape[1] // scale, image.shape[0] // scale)
+        if convert:
+            return cv2.cvtColor(
+                cv2.resize(image, size, interpolation=cv2.INTER_AREA),
+                cv2.COLOR_GRAY2BGR,
+                dst=self._stream_server.get_frame_slot(
+                    (size[1], size[0], 3), image.dtype
+                ),
+            )
+        return cv2.resize(
+            image,
+            size,
+            dst=self._stream_server.get_frame_slot(
+                (size[1], size[0]) + image.shape[2:], image.dtype
+            ),
+            interpolation=cv2.INTER_AREA,
+        )
+
+
+def run_pipelines(pipelines: List[CameraPipeline]) -> None:
+    """Process frames from every camera until all captures are finished.
+
+    Frames are processed on one shared pool of worker threads, with at most one
+    frame in flight per camera so that each pipeline's state is only used by
+    one thread at a time. OpenCV releases the GIL during detection, so cameras
+    are processed in parallel.
+
+    Cameras with detection_tiles share a second pool with one thread per core
+    for their tiles, which is shut down when all captures are finished.
+    """
+    tiled_pipelines = [
+        pipeline
+        for pipeline in pipelines
+        if pipeline.config.local_config.detection_tiles > 1
+    ]
+    detection_executor = None
+    if len(tiled_pipelines) > 0:
+        detection_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=os.cpu_count() or 1, thread_name_prefix="detection"
+        )
+    for pipeline in tiled_pipelines:
+        pipeline.set_detection_executor(detection_executor)
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(pipelines), thread_name_prefix="camera"
+        ) as executor:
+            running: Dict[concurrent.futures.Future, CameraPipeline] = {
+                executor.submit(pipeline.process_frame): pipeline
+                for pipeline in pipelines
+            }
+            while len(running) > 0:
+                done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    pipeline = running.pop(future)
+                    # Re-raises errors from the pipeline, including SystemExit
+                    if future.result():
+                        running[executor.submit(pipeline.process_frame)] = pipeline
+    finally:
+        for pipeline in tiled_pipelines:
+            pipeline.set_detection_executor(None)
+        if detection_executor is not None:
+            detection_executor.shutdown()
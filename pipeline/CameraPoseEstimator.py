@@ -1,7 +1,8 @@
-from typing import List, Union
+from typing import Dict, List, Tuple, Union
 
 import cv2
 import numpy
+import numpy.typing
 from config.config import ConfigStore
 from vision_types import (
     FiducialImageObservation,
@@ -9,9 +10,11 @@ from vision_types import (
 )
 from wpimath.geometry import Pose3d, Rotation3d, Quaternion, Translation3d, Transform3d
 
-from pipeline.coordinate_systems import openCvPoseToWpilib, wpilibTranslationToOpenCv
+from pipeline.camera_model import CameraModel, update_camera_model
+from pipeline.coordinate_systems import openCvPosesToWpilib, wpilibTranslationToOpenCv
 from pipeline.FiducialPoseEstimator import (
     SquareTargetPoseEstimator,
+    refine_pose,
 )
 
 
@@ -32,124 +35,172 @@ class MultiTargetCameraPoseEstimator(CameraPoseEstimator):
 
     def __init__(self) -> None:
         self.fallback_estimator: SquareTargetPoseEstimator = SquareTargetPoseEstimator()
+        self._tag_layout = None
+        self._fid_size: Union[float, None] = None
+        self._tag_corners: Dict[int, numpy.typing.NDArray[numpy.float64]] = {}
+        self._camera_model: Union[CameraModel, None] = None
+        # Previous multi-tag rvec, tvec and error, used to warm start the next
+        # solve
+        self._last_solution: Union[
+            Tuple[
+                numpy.typing.NDArray[numpy.float64],
+                numpy.typing.NDArray[numpy.float64],
+                float,
+            ],
+            None,
+        ] = None
+        self._config_version: Union[int, None] = None
+
+    def _update_tag_corners(self, config_store: ConfigStore) -> None:
+        """Rebuild the OpenCV object points of each tag's corners when the tag
+        layout or size changes."""
+        tag_layout = config_store.remote_config.tag_layout
+        fid_size = config_store.remote_config.fiducial_size_m
+        if fid_size == self._fid_size and (
+            tag_layout is self._tag_layout or tag_layout == self._tag_layout
+        ):
+            return
+        self._tag_layout = tag_layout
+        self._fid_size = fid_size
+
+        self._tag_corners = {}
+        for tag_data in tag_layout["tags"]:
+            tag_pose = Pose3d(
+                Translation3d(
+                    tag_data["pose"]["translation"]["x"],
+                    tag_data["pose"]["translation"]["y"],
+                    tag_data["pose"]["translation"]["z"],
+                ),
+                Rotation3d(
+                    Quaternion(
+                        tag_data["pose"]["rotation"]["quaternion"]["W"],
+                        tag_data["pose"]["rotation"]["quaternion"]["X"],
+                        tag_data["pose"]["rotation"]["quaternion"]["Y"],
+                        tag_data["pose"]["rotation"]["quaternion"]["Z"],
+                    )
+                ),
+            )
+
+            # Transform the corners from the tag center
+            corner_0 = tag_pose + Transform3d(
+                Translation3d(0, fid_size / 2.0, -fid_size / 2.0), Rotation3d()
+            )
+            corner_1 = tag_pose + Transform3d(
+                Translation3d(0, -fid_size / 2.0, -fid_size / 2.0), Rotation3d()
+            )
+            corner_2 = tag_pose + Transform3d(
+                Translation3d(0, -fid_size / 2.0, fid_size / 2.0), Rotation3d()
+            )
+            corner_3 = tag_pose + Transform3d(
+                Translation3d(0, fid_size / 2.0, fid_size / 2.0), Rotation3d()
+            )
+            self._tag_corners[tag_data["ID"]] = numpy.array(
+                [
+                    wpilibTranslationToOpenCv(corner_0.translation()),
+                    wpilibTranslationToOpenCv(corner_1.translation()),
+                    wpilibTranslationToOpenCv(corner_2.translation()),
+                    wpilibTranslationToOpenCv(corner_3.translation()),
+                ]
+            )
 
     def solve_camera_pose(
         self,
         image_observations: List[FiducialImageObservation],
         config_store: ConfigStore,
     ) -> Union[List[PoseObservation], None]:
+        # Only warm start from the previous frame if it had a multi-tag solve
+        last_solution, self._last_solution = self._last_solution, None
+        if config_store.version != self._config_version:
+            self._config_version = config_store.version
+            last_solution = None
+
         # If only one tag or no tag layout
         if (
             len(image_observations) == 1
             or config_store.remote_config.tag_layout is None
         ):
             print(f"Fallback to single pose with {len(image_observations)} observations and {config_store.remote_config.tag_layout}")
-            return [
-                self.fallback_estimator.solve_fiducial_pose(observation, config_store)
-                for observation in image_observations
-            ]
+            return self.fallback_estimator.solve_fiducial_poses(
+                image_observations, config_store
+            )
 
         # Exit if no observations available
         if len(image_observations) == 0:
             return None
 
         # Create set of object and image points
-        fid_size = config_store.remote_config.fiducial_size_m
+        self._update_tag_corners(config_store)
         object_points = []
         image_points = []
         tag_ids = []
-        tag_poses = []
         for observation in image_observations:
-            tag_pose = None
-            for tag_data in config_store.remote_config.tag_layout["tags"]:
-                if tag_data["ID"] == observation.tag_id:
-                    tag_pose = Pose3d(
-                        Translation3d(
-                            tag_data["pose"]["translation"]["x"],
-                            tag_data["pose"]["translation"]["y"],
-                            tag_data["pose"]["translation"]["z"],
-                        ),
-                        Rotation3d(
-                            Quaternion(
-                                tag_data["pose"]["rotation"]["quaternion"]["W"],
-                                tag_data["pose"]["rotation"]["quaternion"]["X"],
-                                tag_data["pose"]["rotation"]["quaternion"]["Y"],
-                                tag_data["pose"]["rotation"]["quaternion"]["Z"],
-                            )
-                        ),
-                    )
-            if tag_pose is not None:
-                # Add object points by transforming from the tag center
-                corner_0 = tag_pose + Transform3d(
-                    Translation3d(0, fid_size / 2.0, -fid_size / 2.0), Rotation3d()
-                )
-                corner_1 = tag_pose + Transform3d(
-                    Translation3d(0, -fid_size / 2.0, -fid_size / 2.0), Rotation3d()
-                )
-                corner_2 = tag_pose + Transform3d(
-                    Translation3d(0, -fid_size / 2.0, fid_size / 2.0), Rotation3d()
-                )
-                corner_3 = tag_pose + Transform3d(
-                    Translation3d(0, fid_size / 2.0, fid_size / 2.0), Rotation3d()
-                )
-                object_points += [
-                    wpilibTranslationToOpenCv(corner_0.translation()),
-                    wpilibTranslationToOpenCv(corner_1.translation()),
-                    wpilibTranslationToOpenCv(corner_2.translation()),
-                    wpilibTranslationToOpenCv(corner_3.translation()),
-                ]
-
-                # Add image points from observation
-                image_points += [
-                    [observation.corners[0][0][0], observation.corners[0][0][1]],
-                    [observation.corners[0][1][0], observation.corners[0][1][1]],
-                    [observation.corners[0][2][0], observation.corners[0][2][1]],
-                    [observation.corners[0][3][0], observation.corners[0][3][1]],
-                ]
-
-                # Add tag ID and pose
+            tag_corners = self._tag_corners.get(observation.tag_id)
+            if tag_corners is not None:
+                object_points.append(tag_corners)
+                image_points.append(observation.corners.reshape(4, 2))
                 tag_ids.append(observation.tag_id)
-                tag_poses.append(tag_pose)
+
+        # No tags in layout
+        if len(tag_ids) == 0:
+            return None
 
         # Single tag, raise exception
-        if len(tag_ids) == 1:
+        elif len(tag_ids) == 1:
             # raise Exception(
             #     "Only one tag in layout, make sure all tags are in the layout"
             # )
             print("Fallback to single pose estimation with one recognized tag id")
-            return [
-                self.fallback_estimator.solve_fiducial_pose(observation, config_store)
-                for observation in image_observations
-            ]
+            return self.fallback_estimator.solve_fiducial_poses(
+                image_observations, config_store
+            )
 
         # Multi-tag, return one pose
         else:
-            # Run SolvePNP with all tags
+            # Undistort all corners at once, after which solves are pinhole-only
+            self._camera_model = update_camera_model(self._camera_model, config_store)
+            camera_matrix = self._camera_model.camera_matrix
+            object_points = numpy.concatenate(object_points)
             try:
-                _, rvecs, tvecs, errors = cv2.solvePnPGeneric(
-                    numpy.array(object_points),
-                    numpy.array(image_points),
-                    config_store.local_config.camera_matrix,
-                    config_store.local_config.distortion_coefficients,
-                    flags=cv2.SOLVEPNP_SQPNP,
+                image_points = self._camera_model.undistort(
+                    numpy.concatenate(image_points)
                 )
             except Exception as e:
                 print(e)
                 return None
 
-            # Calculate WPILib camera pose
-            camera_to_field_pose = openCvPoseToWpilib(tvecs[0], rvecs[0])
-            camera_to_field = Transform3d(
-                camera_to_field_pose.translation(), camera_to_field_pose.rotation()
-            )
-            field_to_camera = camera_to_field.inverse()
-            field_to_camera_pose = Pose3d(
-                field_to_camera.translation(), field_to_camera.rotation()
-            )
+            # Refine the previous solution if possible
+            solution = None
+            if config_store.local_config.pose_warm_start and last_solution is not None:
+                solution = refine_pose(
+                    object_points, image_points, *last_solution, camera_matrix
+                )
+
+            # Run SolvePNP with all tags
+            if solution is None:
+                try:
+                    _, rvecs, tvecs, errors = cv2.solvePnPGeneric(
+                        object_points,
+                        image_points,
+                        camera_matrix,
+                        None,
+                        flags=cv2.SOLVEPNP_SQPNP,
+                    )
+                except Exception as e:
+                    print(e)
+                    return None
+                solution = (rvecs[0].reshape(3), tvecs[0].reshape(3), errors[0][0])
+            if config_store.local_config.pose_warm_start:
+                self._last_solution = solution
+            rvec, tvec, error = solution
+
+            # Invert the field to camera transform to get the camera pose on the
+            # field, then convert to WPILib
+            rotation, _ = cv2.Rodrigues(rvec)
+            field_to_camera_pose = openCvPosesToWpilib(-rotation.T @ tvec, -rvec)
 
             # Return result
             return [
                 PoseObservation(
-                    tag_ids, True, field_to_camera_pose, errors[0][0], None, None
+                    tag_ids, True, field_to_camera_pose, numpy.array([error])
                 )
             ]
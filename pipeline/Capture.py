@@ -1,12 +1,53 @@
-import dataclasses
+import collections
+import functools
+import os
 import sys
+import threading
 import time
-from typing import Tuple
+from typing import Callable, Deque, List, Tuple, Union
 
 import cv2
 import numpy
+import numpy.typing
 from config.config import ConfigStore
 
+from pipeline import v4l2_controls
+
+# Buffer timestamps further than this from the time of the read are rejected
+MAX_BUFFER_AGE_SECS = 1.0
+
+# libjpeg DCT-domain scaled decode flags by scale factor
+REDUCED_DECODE_FLAGS = {
+    2: (cv2.IMREAD_REDUCED_COLOR_2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+    4: (cv2.IMREAD_REDUCED_COLOR_4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+    8: (cv2.IMREAD_REDUCED_COLOR_8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+}
+
+
+def _monotonic_to_wall(monotonic_time: float) -> float:
+    """Convert a CLOCK_MONOTONIC time in seconds to wall clock time."""
+    return time.time() - (time.monotonic() - monotonic_time)
+
+
+def _measure_decode_time(image: cv2.Mat) -> float:
+    """Return how long libjpeg takes to decode and convert a frame like image,
+    taking the fastest of a few runs.
+
+    Camera JPEGs have chroma planes that jpegdec decodes even for grayscale
+    captures, so the frame is always timed as a color decode.
+    """
+    if len(image.shape) == 2:
+        image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    success, jpeg = cv2.imencode(".jpg", image)
+    if not success:
+        return 0.0
+    decode_time = float("inf")
+    for _ in range(3):
+        start = time.perf_counter()
+        cv2.imdecode(jpeg, cv2.IMREAD_COLOR)
+        decode_time = min(decode_time, time.perf_counter() - start)
+    return decode_time
+
 
 class Capture:
     """Interface for receiving camera frames."""
@@ -14,16 +55,41 @@ class Capture:
     def __init__(self) -> None:
         raise NotImplementedError
 
-    def get_frame(self, config_store: ConfigStore) -> Tuple[bool, cv2.Mat]:
-        """Return the next frame from the camera."""
+    def get_frame(self, config_store: ConfigStore) -> Tuple[bool, cv2.Mat, float]:
+        """Return the next frame from the camera and its capture timestamp."""
         raise NotImplementedError
 
+    def stop(self) -> None:
+        """Release the camera."""
+        pass
+
+    def is_finished(self) -> bool:
+        """Return whether no more frames will be available."""
+        return False
+
+    def get_decode_scale(self) -> int:
+        """Return how many times smaller returned frames are than the camera resolution."""
+        return 1
+
+    def get_full_resolution_loader(self) -> Union[Callable[[], cv2.Mat], None]:
+        """Return a function that decodes the last frame returned by get_frame
+        in grayscale at full resolution, or None if frames are not reduced."""
+        return None
+
+    def get_dropped_frames(self) -> int:
+        """Return how many frames were read from the camera but never returned
+        by get_frame."""
+        return 0
+
     @classmethod
     def _config_changed(cls, config_a: ConfigStore, config_b: ConfigStore) -> bool:
+        """Return whether the capture session must be restarted."""
         if config_a is None and config_b is None:
             return False
         if config_a is None or config_b is None:
             return True
+        if config_a.version == config_b.version:
+            return False
 
         remote_a = config_a.remote_config
         remote_b = config_b.remote_config
@@ -31,7 +97,21 @@ class Capture:
         return (
             remote_a.camera_resolution_width != remote_b.camera_resolution_width
             or remote_a.camera_resolution_height != remote_b.camera_resolution_height
-            or remote_a.camera_auto_exposure != remote_b.camera_auto_exposure
+        )
+
+    @classmethod
+    def _controls_changed(cls, config_a: ConfigStore, config_b: ConfigStore) -> bool:
+        """Return whether camera controls can be updated on the running session."""
+        if config_a is None or config_b is None:
+            return False
+        if config_a.version == config_b.version:
+            return False
+
+        remote_a = config_a.remote_config
+        remote_b = config_b.remote_config
+
+        return (
+            remote_a.camera_auto_exposure != remote_b.camera_auto_exposure
             or remote_a.camera_exposure != remote_b.camera_exposure
             or remote_a.camera_gain != remote_b.camera_gain
         )
@@ -46,7 +126,7 @@ class DefaultCapture(Capture):
     _video = None
     _last_config: ConfigStore
 
-    def get_frame(self, config_store: ConfigStore) -> Tuple[bool, cv2.Mat]:
+    def get_frame(self, config_store: ConfigStore) -> Tuple[bool, cv2.Mat, float]:
         if self._video is not None and self._config_changed(
             self._last_config, config_store
         ):
@@ -64,19 +144,36 @@ class DefaultCapture(Capture):
                 cv2.CAP_PROP_FRAME_HEIGHT,
                 config_store.remote_config.camera_resolution_height,
             )
-            self._video.set(
-                cv2.CAP_PROP_AUTO_EXPOSURE,
-                config_store.remote_config.camera_auto_exposure,
-            )
-            self._video.set(
-                cv2.CAP_PROP_EXPOSURE, config_store.remote_config.camera_exposure
-            )
-            self._video.set(cv2.CAP_PROP_GAIN, config_store.remote_config.camera_gain)
+            self._set_controls(config_store)
+        elif self._controls_changed(self._last_config, config_store):
+            self._set_controls(config_store)
 
         self._last_config = config_store
 
         retval, image = self._video.read()
-        return retval, image
+        read_time = time.monotonic()
+        timestamp = time.time()
+        if self._video.getBackendName() == "V4L2":
+            # V4L2 reports the driver's CLOCK_MONOTONIC buffer timestamp
+            buffer_time = self._video.get(cv2.CAP_PROP_POS_MSEC) / 1000.0
+            if 0 <= read_time - buffer_time < MAX_BUFFER_AGE_SECS:
+                timestamp = _monotonic_to_wall(buffer_time)
+        return retval, image, timestamp
+
+    def _set_controls(self, config_store: ConfigStore) -> None:
+        self._video.set(
+            cv2.CAP_PROP_AUTO_EXPOSURE,
+            config_store.remote_config.camera_auto_exposure,
+        )
+        self._video.set(
+            cv2.CAP_PROP_EXPOSURE, config_store.remote_config.camera_exposure
+        )
+        self._video.set(cv2.CAP_PROP_GAIN, config_store.remote_config.camera_gain)
+
+    def stop(self) -> None:
+        if self._video is not None:
+            self._video.release()
+            self._video = None
 
 
 class GStreamerCapture(Capture):
@@ -86,9 +183,14 @@ class GStreamerCapture(Capture):
         pass
 
     _video = None
-    _last_config: ConfigStore
+    _last_config: Union[ConfigStore, None] = None
+    _session_start: float = 0.0
+    _base_time: Union[float, None] = None
+    # Time between v4l2src stamping a buffer and the appsink receiving it
+    _pipeline_latency: Union[float, None] = None
+    _jpeg_data: Union[numpy.typing.NDArray[numpy.uint8], None] = None
 
-    def get_frame(self, config_store: ConfigStore) -> Tuple[bool, cv2.Mat]:
+    def get_frame(self, config_store: ConfigStore) -> Tuple[bool, cv2.Mat, float]:
         if self._video is not None and self._config_changed(
             self._last_config, config_store
         ):
@@ -96,6 +198,35 @@ class GStreamerCapture(Capture):
             self._video.release()
             self._video = None
             time.sleep(2)
+        elif self._video is not None and self._controls_changed(
+            self._last_config, config_store
+        ):
+            controls = [
+                (
+                    v4l2_controls.V4L2_CID_EXPOSURE_AUTO,
+                    config_store.remote_config.camera_auto_exposure,
+                ),
+                (v4l2_controls.V4L2_CID_GAIN, config_store.remote_config.camera_gain),
+            ]
+            if (
+                config_store.remote_config.camera_auto_exposure
+                == v4l2_controls.V4L2_EXPOSURE_MANUAL
+            ):
+                # The driver rejects exposure changes unless in manual mode
+                controls.append(
+                    (
+                        v4l2_controls.V4L2_CID_EXPOSURE_ABSOLUTE,
+                        config_store.remote_config.camera_exposure,
+                    )
+                )
+            try:
+                v4l2_controls.set_controls(config_store.local_config.camera, controls)
+                print("Updated camera controls")
+            except OSError as e:
+                print("Could not update camera controls, stopping capture session:", e)
+                self._video.release()
+                self._video = None
+                time.sleep(2)
 
         if self._video is None:
             print("Starting capture session")
@@ -112,20 +243,29 @@ class GStreamerCapture(Capture):
                 + " ! image/jpeg,format=MJPG,"
                 + f"width={config_store.remote_config.camera_resolution_width},"
                 + f"height={config_store.remote_config.camera_resolution_height}"
-                + " ! jpegdec ! video/x-raw !"
-                + " videoconvert ! video/x-raw,format=BGR ! appsink drop=1"
             )
+            if self._get_reduced_decode_flags(config_store) is None:
+                src += (
+                    " ! jpegdec ! video/x-raw !"
+                    + " videoconvert ! video/x-raw,format="
+                    + (
+                        "GRAY8"
+                        if config_store.local_config.grayscale_capture
+                        else "BGR"
+                    )
+                )
+            src += " ! appsink drop=1 max-buffers=1 sync=0"
             print(src)
+            self._session_start = time.monotonic()
             self._video = cv2.VideoCapture(
                 src,
                 cv2.CAP_GSTREAMER,
             )
+            self._base_time = time.monotonic()
+            self._pipeline_latency = None
             print("Capture session ready")
 
-        self._last_config = ConfigStore(
-            dataclasses.replace(config_store.local_config),
-            dataclasses.replace(config_store.remote_config),
-        )
+        self._last_config = config_store
 
         if self._video is not None:
             retval, image = self._video.read()
@@ -134,11 +274,332 @@ class GStreamerCapture(Capture):
                 self._video.release()
                 self._video = None  # Force reconnect
                 sys.exit(1)
-            return retval, image
+            reduced_decode_flags = self._get_reduced_decode_flags(config_store)
+            if self._pipeline_latency is None:
+                # Buffers decoded by jpegdec reach the appsink a decode later
+                # than they were stamped. libjpeg-turbo backs both jpegdec and
+                # OpenCV, so time the same decode once per session.
+                self._pipeline_latency = (
+                    0.0
+                    if reduced_decode_flags is not None
+                    else _measure_decode_time(image)
+                )
+            timestamp = self._get_buffer_timestamp()
+
+            if reduced_decode_flags is not None:
+                # The appsink returns the encoded JPEG, decode it at reduced
+                # scale and keep it for decoding at full resolution on demand
+                self._jpeg_data = image
+                image = cv2.imdecode(
+                    image,
+                    reduced_decode_flags[
+                        1 if config_store.local_config.grayscale_capture else 0
+                    ],
+                )
+                if image is None:
+                    return False, cv2.Mat(numpy.ndarray([])), 0.0
+            return retval, image, timestamp
+        else:
+            return False, cv2.Mat(numpy.ndarray([])), 0.0
+
+    @classmethod
+    def _get_reduced_decode_flags(
+        cls, config_store: ConfigStore
+    ) -> Union[Tuple[int, int], None]:
+        """Return the color and grayscale decode flags for the configured scale."""
+        return REDUCED_DECODE_FLAGS.get(config_store.local_config.jpeg_decode_scale)
+
+    def get_decode_scale(self) -> int:
+        if (
+            self._last_config is None
+            or self._get_reduced_decode_flags(self._last_config) is None
+        ):
+            return 1
+        return self._last_config.local_config.jpeg_decode_scale
+
+    def get_full_resolution_loader(self) -> Union[Callable[[], cv2.Mat], None]:
+        if self._jpeg_data is None or self.get_decode_scale() == 1:
+            return None
+        return functools.partial(cv2.imdecode, self._jpeg_data, cv2.IMREAD_GRAYSCALE)
+
+    def _get_buffer_timestamp(self) -> float:
+        """Return the wall clock capture time of the last frame read.
+
+        The appsink does not sync to the clock, so its position is the PTS of
+        the last buffer in pipeline running time. Adding the pipeline base time
+        gives the CLOCK_MONOTONIC time that v4l2src stamped on the buffer. The
+        base time is not exposed by OpenCV, so it is bounded from above by the
+        end of the session start and by each read (a buffer cannot be read
+        before it was captured), and from below by the start of the session.
+
+        The upper bound converges to the base time plus the shortest time a
+        buffer takes to reach the appsink, so the measured pipeline latency
+        is subtracted from the result.
+        """
+        read_time = time.monotonic()
+        pts = self._video.get(cv2.CAP_PROP_POS_MSEC) / 1000.0
+        if pts <= 0 or self._base_time is None:
+            return time.time()
+
+        self._base_time = max(
+            self._session_start, min(self._base_time, read_time - pts)
+        )
+        buffer_time = self._base_time + pts - self._pipeline_latency
+        if read_time - buffer_time > MAX_BUFFER_AGE_SECS:
+            return time.time()
+        return _monotonic_to_wall(buffer_time)
+
+    def stop(self) -> None:
+        if self._video is not None:
+            self._video.release()
+            self._video = None
+
+
+class ThreadedCapture(Capture):
+    """Read from another capture on a background thread.
+
+    Frames are pulled continuously into a small ring buffer so that sensor
+    readout overlaps with processing. Each call returns the newest frame and
+    discards any older ones.
+    """
+
+    def __init__(self, capture: Capture, buffer_size: int = 2) -> None:
+        self._capture = capture
+        self._frames: Deque[
+            Tuple[cv2.Mat, float, Union[Callable[[], cv2.Mat], None]]
+        ] = collections.deque(maxlen=buffer_size)
+        self._full_resolution_loader: Union[Callable[[], cv2.Mat], None] = None
+        self._condition = threading.Condition()
+        self._config_store: Union[ConfigStore, None] = None
+        self._thread: Union[threading.Thread, None] = None
+        self._running = False
+        self._error: Union[BaseException, None] = None
+        self._dropped_frames = 0
+
+    def _run(self) -> None:
+        while self._running:
+            with self._condition:
+                config_store = self._config_store
+            try:
+                success, image, timestamp = self._capture.get_frame(config_store)
+            except BaseException as e:
+                # Includes SystemExit raised by a failed capture session, which
+                # is re-raised on the main thread by get_frame
+                with self._condition:
+                    self._error = e
+                    self._condition.notify_all()
+                return
+            if not success:
+                time.sleep(0.5)
+                continue
+            full_resolution_loader = self._capture.get_full_resolution_loader()
+            with self._condition:
+                if len(self._frames) == self._frames.maxlen:
+                    self._dropped_frames += 1
+                self._frames.append((image, timestamp, full_resolution_loader))
+                self._condition.notify_all()
+
+    def get_frame(self, config_store: ConfigStore) -> Tuple[bool, cv2.Mat, float]:
+        with self._condition:
+            self._config_store = config_store
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+        with self._condition:
+            self._condition.wait_for(
+                lambda: len(self._frames) > 0 or self._error is not None, timeout=1.0
+            )
+            if self._error is not None:
+                raise self._error
+            if len(self._frames) == 0:
+                return False, cv2.Mat(numpy.ndarray([])), 0.0
+            image, timestamp, self._full_resolution_loader = self._frames.pop()
+            self._dropped_frames += len(self._frames)
+            self._frames.clear()
+        return True, image, timestamp
+
+    def stop(self) -> None:
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout=2.0)
+            self._thread = None
+        self._capture.stop()
+
+    def is_finished(self) -> bool:
+        with self._condition:
+            return len(self._frames) == 0 and self._capture.is_finished()
+
+    def get_decode_scale(self) -> int:
+        return self._capture.get_decode_scale()
+
+    def get_full_resolution_loader(self) -> Union[Callable[[], cv2.Mat], None]:
+        return self._full_resolution_loader
+
+    def get_dropped_frames(self) -> int:
+        return self._dropped_frames
+
+
+class ReplayCapture(Capture):
+    """Read recorded frames from a video file or a directory of images.
+
+    Each frame is returned with its original timestamp, taken from a
+    timestamps file (one time in seconds per line) when one exists. This is
+    "timestamps.txt" inside an image directory or "<name>.timestamps.txt" next
+    to a video. Otherwise image names are parsed as timestamps, falling back to
+    the video position or the frame index at DEFAULT_FPS.
+
+    Frames are paced by their timestamps when rate is None, at a fixed rate in
+    frames per second, or returned as fast as possible when rate is 0.
+    """
+
+    DEFAULT_FPS = 30.0
+    TIMESTAMPS_FILENAME = "timestamps.txt"
+    IMAGE_EXTENSIONS = (".bmp", ".jpeg", ".jpg", ".png", ".tif", ".tiff")
+
+    def __init__(
+        self, path: str, rate: Union[float, None] = None, loop: bool = False
+    ) -> None:
+        self._path = path
+        self._rate = rate
+        self._loop = loop
+        self._video: Union[cv2.VideoCapture, None] = None
+        self._image_paths: List[str] = []
+        self._timestamps: Union[List[float], None] = None
+        self._index = 0
+        self._start_time: Union[float, None] = None
+        self._first_timestamp = 0.0
+        self._finished = False
+        self._decode_scale = 1
+        self._full_resolution_loader: Union[Callable[[], cv2.Mat], None] = None
+
+        if os.path.isdir(path):
+            self._image_paths = sorted(
+                os.path.join(path, x)
+                for x in os.listdir(path)
+                if x.lower().endswith(self.IMAGE_EXTENSIONS)
+            )
+            timestamps_path = os.path.join(path, self.TIMESTAMPS_FILENAME)
+            if not os.path.exists(timestamps_path):
+                self._timestamps = self._parse_filename_timestamps(self._image_paths)
+        else:
+            timestamps_path = os.path.splitext(path)[0] + "." + self.TIMESTAMPS_FILENAME
+        if os.path.exists(timestamps_path):
+            with open(timestamps_path, "r") as timestamps_file:
+                self._timestamps = [
+                    float(x) for x in timestamps_file.read().split() if len(x) > 0
+                ]
+
+    @classmethod
+    def _parse_filename_timestamps(
+        cls, image_paths: List[str]
+    ) -> Union[List[float], None]:
+        try:
+            return [
+                float(os.path.splitext(os.path.basename(x))[0]) for x in image_paths
+            ]
+        except ValueError:
+            return None
+
+    def _read(self, config_store: ConfigStore) -> Tuple[bool, cv2.Mat, float]:
+        """Read the frame at the current index without pacing."""
+        grayscale = config_store.local_config.grayscale_capture
+        reduced_decode_flags = REDUCED_DECODE_FLAGS.get(
+            config_store.local_config.jpeg_decode_scale
+        )
+        self._full_resolution_loader = None
+        if len(self._image_paths) > 0:
+            if self._index >= len(self._image_paths):
+                return False, cv2.Mat(numpy.ndarray([])), 0.0
+            image_path = self._image_paths[self._index]
+            if reduced_decode_flags is None:
+                image = cv2.imread(
+                    image_path, cv2.IMREAD_GRAYSCALE if grayscale else cv2.IMREAD_COLOR
+                )
+            else:
+                image = cv2.imread(
+                    image_path, reduced_decode_flags[1 if grayscale else 0]
+                )
+                self._full_resolution_loader = functools.partial(
+                    cv2.imread, image_path, cv2.IMREAD_GRAYSCALE
+                )
+            position = self._index / self.DEFAULT_FPS
+        else:
+            if self._video is None:
+                self._video = cv2.VideoCapture(self._path)
+            retval, image = self._video.read()
+            if not retval:
+                return False, cv2.Mat(numpy.ndarray([])), 0.0
+            if reduced_decode_flags is not None:
+                scale = config_store.local_config.jpeg_decode_scale
+                self._full_resolution_loader = functools.partial(
+                    cv2.cvtColor, image, cv2.COLOR_BGR2GRAY
+                )
+                image = cv2.resize(
+                    image,
+                    None,
+                    fx=1.0 / scale,
+                    fy=1.0 / scale,
+                    interpolation=cv2.INTER_AREA,
+                )
+            if grayscale:
+                image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+            position = self._video.get(cv2.CAP_PROP_POS_MSEC) / 1000.0
+        self._decode_scale = (
+            1
+            if reduced_decode_flags is None
+            else config_store.local_config.jpeg_decode_scale
+        )
+
+        if self._timestamps is not None and self._index < len(self._timestamps):
+            timestamp = self._timestamps[self._index]
+        else:
+            timestamp = position
+        return image is not None, image, timestamp
+
+    def get_frame(self, config_store: ConfigStore) -> Tuple[bool, cv2.Mat, float]:
+        if self._finished:
+            return False, cv2.Mat(numpy.ndarray([])), 0.0
+
+        retval, image, timestamp = self._read(config_store)
+        if not retval and self._loop and self._index > 0:
+            self.stop()
+            self._index = 0
+            self._start_time = None
+            retval, image, timestamp = self._read(config_store)
+        if not retval:
+            print("Replay finished after", self._index, "frames")
+            self._finished = True
+            return False, image, timestamp
+
+        # Wait until the frame is due
+        if self._start_time is None:
+            self._start_time = time.time()
+            self._first_timestamp = timestamp
+        if self._rate is None:
+            due_time = self._start_time + (timestamp - self._first_timestamp)
+        elif self._rate > 0:
+            due_time = self._start_time + self._index / self._rate
         else:
-            return False, cv2.Mat(numpy.ndarray([]))
+            due_time = 0.0
+        delay = due_time - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+        self._index += 1
+        return True, image, timestamp
 
-    def stop(self):
+    def stop(self) -> None:
         if self._video is not None:
             self._video.release()
             self._video = None
+
+    def is_finished(self) -> bool:
+        return self._finished
+
+    def get_decode_scale(self) -> int:
+        return self._decode_scale
+
+    def get_full_resolution_loader(self) -> Union[Callable[[], cv2.Mat], None]:
+        return self._full_resolution_loader
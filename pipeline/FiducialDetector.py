@@ -1,9 +1,44 @@
-from typing import List
+import concurrent.futures
+from typing import Any, Dict, List, Tuple, Union
 
 import cv2
+import numpy
+import numpy.typing
 from config.config import ConfigStore
 from vision_types import FiducialImageObservation
 
+SUBPIX_CRITERIA = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.01)
+
+# Named cv2.aruco.DetectorParameters overrides, selected by the detector_profile
+# config. The adaptive threshold window sizes and perimeter limits dominate the
+# cost of detection. Use tune_detector.py to compare profiles on recordings.
+DETECTOR_PROFILES: Dict[str, Dict[str, Any]] = {
+    "default": {},
+    "fast": {
+        "adaptiveThreshWinSizeMin": 13,
+        "adaptiveThreshWinSizeMax": 13,
+        "minMarkerPerimeterRate": 0.05,
+    },
+    "accurate": {
+        "cornerRefinementMethod": cv2.aruco.CORNER_REFINE_SUBPIX,
+    },
+    "long_range": {
+        "adaptiveThreshWinSizeMin": 5,
+        "adaptiveThreshWinSizeMax": 25,
+        "adaptiveThreshWinSizeStep": 10,
+        "minMarkerPerimeterRate": 0.01,
+        "cornerRefinementMethod": cv2.aruco.CORNER_REFINE_SUBPIX,
+    },
+}
+
+
+def make_detector_parameters(profile: Dict[str, Any]) -> cv2.aruco.DetectorParameters:
+    """Return detector parameters with the overrides from a profile applied."""
+    parameters = cv2.aruco.DetectorParameters()
+    for name, value in profile.items():
+        setattr(parameters, name, value)
+    return parameters
+
 
 class FiducialDetector:
     def __init__(self) -> None:
@@ -16,18 +51,348 @@ class FiducialDetector:
 
 
 class ArucoFiducialDetector(FiducialDetector):
+    # Padding around tracked tags, as a fraction of the tag size
+    TRACKING_PADDING = 0.5
+    TRACKING_MIN_PADDING_PX = 16
+    # Extra extent of each tile beyond the configured overlap, so that a tag
+    # in the overlap keeps a quiet zone inside the tile
+    TILE_MARGIN_PX = 16
+
     def __init__(self, dictionary_id) -> None:
-        self._aruco_dict = cv2.aruco.getPredefinedDictionary(dictionary_id)
+        self._base_aruco_dict = cv2.aruco.getPredefinedDictionary(dictionary_id)
+        self._aruco_dict = self._base_aruco_dict
+        self._layout_ids: Union[Tuple[int, ...], None] = None
+        self._id_map: Union[numpy.typing.NDArray[numpy.int32], None] = None
         self._aruco_params = cv2.aruco.DetectorParameters()
+        self._aruco_detector = cv2.aruco.ArucoDetector(
+            self._aruco_dict, self._aruco_params
+        )
+        self._profile = "default"
+        self._config_version: Union[int, None] = None
+        self._last_observations: List[FiducialImageObservation] = []
+        self._frames_since_full_scan = 0
+        self._executor: Union[concurrent.futures.Executor, None] = None
+
+    def set_executor(self, executor: Union[concurrent.futures.Executor, None]) -> None:
+        """Set the worker pool that tiles and tracked regions are detected on,
+        owned by the caller. Without one they are detected one at a time."""
+        self._executor = executor
 
     def detect_fiducials(
         self, image: cv2.Mat, config_store: ConfigStore
     ) -> List[FiducialImageObservation]:
-        corners, ids, _ = cv2.aruco.detectMarkers(
-            image, self._aruco_dict, parameters=self._aruco_params
+        if config_store.version != self._config_version:
+            self._config_version = config_store.version
+            self._update_profile(config_store)
+            self._update_dictionary(config_store)
+        full_scan_interval = config_store.local_config.tracking_full_scan_interval
+        observations = None
+        if (
+            full_scan_interval > 0
+            and len(self._last_observations) > 0
+            and self._frames_since_full_scan < full_scan_interval
+        ):
+            observations = self._detect_tracked(image)
+            if {x.tag_id for x in observations} >= {
+                x.tag_id for x in self._last_observations
+            }:
+                self._frames_since_full_scan += 1
+            else:
+                # A tracked tag was lost, rescan the whole frame
+                observations = None
+
+        if observations is None:
+            observations = self._detect_full(image, config_store)
+            self._frames_since_full_scan = 0
+        self._last_observations = observations
+        return observations
+
+    def _update_profile(self, config_store: ConfigStore) -> None:
+        """Rebuild the detector when the selected profile changes."""
+        profile = config_store.remote_config.detector_profile
+        if profile == self._profile:
+            return
+        self._profile = profile
+        if profile not in DETECTOR_PROFILES:
+            print('Unknown detector profile "' + profile + '", using default')
+            profile = "default"
+        print('Using detector profile "' + profile + '"')
+        self._aruco_params = make_detector_parameters(DETECTOR_PROFILES[profile])
+        self._aruco_detector = cv2.aruco.ArucoDetector(
+            self._aruco_dict, self._aruco_params
+        )
+
+    def _update_dictionary(self, config_store: ConfigStore) -> None:
+        """Restrict the dictionary to the IDs in the active tag layout.
+
+        Fewer codewords make decoding each candidate cheaper and reject IDs
+        that cannot be on the field. Detected indices are mapped back to the
+        real tag IDs by _id_map.
+        """
+        tag_layout = config_store.remote_config.tag_layout
+        layout_ids = None
+        if tag_layout is not None:
+            layout_ids = tuple(
+                sorted(
+                    {
+                        tag_data["ID"]
+                        for tag_data in tag_layout["tags"]
+                        if 0 <= tag_data["ID"] < len(self._base_aruco_dict.bytesList)
+                    }
+                )
+            )
+            if len(layout_ids) == 0:
+                layout_ids = None
+        if layout_ids == self._layout_ids:
+            return
+        self._layout_ids = layout_ids
+
+        if layout_ids is None:
+            self._aruco_dict = self._base_aruco_dict
+            self._id_map = None
+        else:
+            self._aruco_dict = cv2.aruco.Dictionary(
+                self._base_aruco_dict.bytesList[list(layout_ids)],
+                self._base_aruco_dict.markerSize,
+                self._base_aruco_dict.maxCorrectionBits,
+            )
+            self._id_map = numpy.array(layout_ids, dtype=numpy.int32)
+        self._aruco_detector.setDictionary(self._aruco_dict)
+        self._last_observations = []
+
+    def _detect_full(
+        self, image: cv2.Mat, config_store: ConfigStore
+    ) -> List[FiducialImageObservation]:
+        """Detect tags in the whole frame, decimating it first if configured."""
+        decimation = config_store.local_config.detection_decimation
+        if decimation > 1:
+            decimated_image = cv2.resize(
+                image,
+                None,
+                fx=1.0 / decimation,
+                fy=1.0 / decimation,
+                interpolation=cv2.INTER_AREA,
+            )
+            return refine_scaled_observations(
+                self._detect_tiled(decimated_image, config_store), image, decimation
+            )
+        return self._detect_tiled(image, config_store)
+
+    def _detect_tiled(
+        self, image: cv2.Mat, config_store: ConfigStore
+    ) -> List[FiducialImageObservation]:
+        """Detect tags in overlapping tiles of the frame, in parallel when a
+        worker pool has been set.
+
+        Each tile extends detection_tile_overlap plus TILE_MARGIN_PX past its
+        borders, so a tag whose bounding box is at most twice the overlap
+        across lies entirely within some tile. Larger tags are found by a
+        pass over the whole frame shrunk by the number of tiles, alongside
+        the tiles, with corners refined on the full frame.
+        """
+        tiles = config_store.local_config.detection_tiles
+        if tiles <= 1:
+            return self._detect(image)
+
+        if self._executor is None:
+            coarse_observations = self._detect_coarse(image, tiles)
+        else:
+            coarse_future = self._executor.submit(self._detect_coarse, image, tiles)
+
+        height, width = image.shape[0], image.shape[1]
+        extent = config_store.local_config.detection_tile_overlap + self.TILE_MARGIN_PX
+        regions = []
+        for row in range(tiles):
+            for column in range(tiles):
+                regions.append(
+                    [
+                        max(width * column // tiles - extent, 0),
+                        max(height * row // tiles - extent, 0),
+                        min(width * (column + 1) // tiles + extent, width),
+                        min(height * (row + 1) // tiles + extent, height),
+                    ]
+                )
+        observations = self._detect_regions(image, regions)
+        if self._executor is not None:
+            coarse_observations = coarse_future.result()
+        # Tile detections come first so they are kept over coarse duplicates
+        return _deduplicate_observations(observations + coarse_observations)
+
+    def _detect_coarse(
+        self, image: cv2.Mat, scale: int
+    ) -> List[FiducialImageObservation]:
+        """Detect tags in the whole frame shrunk by scale, refining their
+        corners on the full frame."""
+        reduced_image = cv2.resize(
+            image,
+            None,
+            fx=1.0 / scale,
+            fy=1.0 / scale,
+            interpolation=cv2.INTER_AREA,
         )
+        return refine_scaled_observations(self._detect(reduced_image), image, scale)
+
+    def _detect(
+        self, image: cv2.Mat, offset: Tuple[int, int] = (0, 0)
+    ) -> List[FiducialImageObservation]:
+        corners, ids, _ = self._aruco_detector.detectMarkers(image)
         if len(corners) == 0:
             return []
+        if offset != (0, 0):
+            corners = [corner + numpy.float32(offset) for corner in corners]
+        if self._id_map is not None:
+            ids = self._id_map[ids]
         return [
             FiducialImageObservation(id[0], corner) for id, corner in zip(ids, corners)
         ]
+
+    def _detect_tracked(self, image: cv2.Mat) -> List[FiducialImageObservation]:
+        """Detect tags only in padded regions around the last observations."""
+        height, width = image.shape[0], image.shape[1]
+        regions = []
+        for observation in self._last_observations:
+            corners = observation.corners.reshape(4, 2)
+            corner_min = corners.min(axis=0)
+            corner_max = corners.max(axis=0)
+            padding = max(
+                (corner_max - corner_min).max() * self.TRACKING_PADDING,
+                self.TRACKING_MIN_PADDING_PX,
+            )
+            regions.append(
+                [
+                    max(int(corner_min[0] - padding), 0),
+                    max(int(corner_min[1] - padding), 0),
+                    min(int(corner_max[0] + padding) + 1, width),
+                    min(int(corner_max[1] + padding) + 1, height),
+                ]
+            )
+
+        return self._detect_regions(image, _merge_regions(regions))
+
+    def _detect_regions(
+        self, image: cv2.Mat, regions: List[List[int]]
+    ) -> List[FiducialImageObservation]:
+        """Detect tags in (x_min, y_min, x_max, y_max) regions of the frame,
+        using the worker pool when one has been set."""
+        crops = [
+            (image[y_min:y_max, x_min:x_max], (x_min, y_min))
+            for x_min, y_min, x_max, y_max in regions
+        ]
+        if self._executor is None or len(crops) == 1:
+            results = [self._detect(crop, offset) for crop, offset in crops]
+        else:
+            results = self._executor.map(lambda x: self._detect(*x), crops)
+
+        observations = []
+        for result in results:
+            observations += result
+        return observations
+
+
+def _merge_regions(regions: List[List[int]]) -> List[List[int]]:
+    """Merge overlapping (x_min, y_min, x_max, y_max) regions."""
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(regions)):
+            for j in range(i + 1, len(regions)):
+                a, b = regions[i], regions[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    regions[i] = [
+                        min(a[0], b[0]),
+                        min(a[1], b[1]),
+                        max(a[2], b[2]),
+                        max(a[3], b[3]),
+                    ]
+                    del regions[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return regions
+
+
+def _deduplicate_observations(
+    image_observations: List[FiducialImageObservation],
+) -> List[FiducialImageObservation]:
+    """Remove repeated detections of the same tag from overlapping regions."""
+    observations = []
+    centers = []
+    for observation in image_observations:
+        corners = observation.corners.reshape(4, 2)
+        center = corners.mean(axis=0)
+        size = numpy.linalg.norm(corners[0] - corners[2])
+        if not any(
+            tag_id == observation.tag_id
+            and numpy.linalg.norm(center - other_center) < size / 2
+            for tag_id, other_center in centers
+        ):
+            observations.append(observation)
+            centers.append((observation.tag_id, center))
+    return observations
+
+
+def scale_observations(
+    image_observations: List[FiducialImageObservation], scale: float
+) -> List[FiducialImageObservation]:
+    """Scale corners found on an image reduced by scale up to full resolution."""
+    return [
+        FiducialImageObservation(
+            observation.tag_id,
+            ((observation.corners + 0.5) * scale - 0.5).astype(numpy.float32),
+        )
+        for observation in image_observations
+    ]
+
+
+def refine_scaled_observations(
+    image_observations: List[FiducialImageObservation],
+    image: cv2.Mat,
+    scale: float,
+) -> List[FiducialImageObservation]:
+    """Scale corners found on a reduced image up to the full-resolution image
+    and refine them to sub-pixel accuracy in a small window around each tag.
+
+    Only the windows are read, so a BGR image is converted to grayscale per
+    window rather than for the whole frame. Windows clipped by the image edge
+    use a smaller search window, and corners are left unrefined if even that
+    does not fit.
+    """
+    half_window = int(numpy.ceil(scale)) + 1
+    padding = half_window + 2
+    refined_observations = []
+    for observation in scale_observations(image_observations, scale):
+        corners = observation.corners.reshape(4, 2)
+        x_min, y_min = numpy.maximum(
+            numpy.floor(corners.min(axis=0)).astype(int) - padding, 0
+        )
+        x_max, y_max = numpy.minimum(
+            numpy.ceil(corners.max(axis=0)).astype(int) + padding + 1,
+            (image.shape[1], image.shape[0]),
+        )
+        window = image[y_min:y_max, x_min:x_max]
+        # cornerSubPix needs the image to be at least 2 * half_window + 5 wide
+        window_half_window = min(half_window, (min(window.shape[:2]) - 5) // 2)
+        if window_half_window < 1:
+            refined_observations.append(observation)
+            continue
+        if len(window.shape) == 3:
+            window = cv2.cvtColor(window, cv2.COLOR_BGR2GRAY)
+
+        window_corners = (corners - (x_min, y_min)).astype(numpy.float32)
+        cv2.cornerSubPix(
+            window,
+            window_corners,
+            (window_half_window, window_half_window),
+            (-1, -1),
+            SUBPIX_CRITERIA,
+        )
+        refined_observations.append(
+            FiducialImageObservation(
+                observation.tag_id,
+                (window_corners + (x_min, y_min))
+                .astype(numpy.float32)
+                .reshape(1, 4, 2),
+            )
+        )
+    return refined_observations
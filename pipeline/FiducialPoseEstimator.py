@@ -1,14 +1,93 @@
-from typing import Union
+import math
+from typing import Dict, List, Tuple, Union
 
 import cv2
 import numpy
+import numpy.typing
 from config.config import ConfigStore
 from vision_types import (
     FiducialImageObservation,
     PoseObservation,
 )
 
-from pipeline.coordinate_systems import openCvPoseToWpilib
+from pipeline.camera_model import CameraModel, update_camera_model
+from pipeline.coordinate_systems import openCvPosesToWpilib
+
+# Rotation vectors, translation vectors and reprojection errors of the
+# candidate poses of one target
+Solution = Tuple[
+    numpy.typing.NDArray[numpy.float64],
+    numpy.typing.NDArray[numpy.float64],
+    numpy.typing.NDArray[numpy.float64],
+]
+
+# Levenberg-Marquardt settings when refining the previous frame's pose. From a
+# good starting point this converges in a few iterations.
+WARM_START_CRITERIA = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 5, 1e-6)
+
+# A refined pose is discarded in favor of a cold solve when its reprojection
+# error exceeds this multiple of the previous error (and the minimum in pixels)
+WARM_START_ERROR_RATIO = 2.0
+WARM_START_MIN_ERROR_PX = 1.0
+
+
+def square_object_points(fid_size: float) -> numpy.typing.NDArray[numpy.float64]:
+    """Return the corners of a square target in the order used by IPPE-square."""
+    return numpy.array(
+        [
+            [-fid_size / 2.0, fid_size / 2.0, 0.0],
+            [fid_size / 2.0, fid_size / 2.0, 0.0],
+            [fid_size / 2.0, -fid_size / 2.0, 0.0],
+            [-fid_size / 2.0, -fid_size / 2.0, 0.0],
+        ]
+    )
+
+
+def refine_pose(
+    object_points: numpy.typing.NDArray[numpy.float64],
+    image_points: numpy.typing.NDArray[numpy.float64],
+    rvec: numpy.typing.NDArray[numpy.float64],
+    tvec: numpy.typing.NDArray[numpy.float64],
+    last_error: float,
+    camera_matrix: numpy.typing.NDArray[numpy.float64],
+) -> Union[
+    Tuple[
+        numpy.typing.NDArray[numpy.float64], numpy.typing.NDArray[numpy.float64], float
+    ],
+    None,
+]:
+    """Refine a pose from the previous frame with solvePnPRefineLM, given
+    undistorted image points.
+
+    Returns the refined rvec, tvec and RMS reprojection error, or None if the
+    error jumped and the pose should be solved from scratch.
+    """
+    try:
+        rvec, tvec = cv2.solvePnPRefineLM(
+            object_points,
+            image_points,
+            camera_matrix,
+            None,
+            numpy.array(rvec, dtype=numpy.float64).reshape(3, 1),
+            numpy.array(tvec, dtype=numpy.float64).reshape(3, 1),
+            WARM_START_CRITERIA,
+        )
+    except Exception as e:
+        print(e)
+        return None
+    projected, _ = cv2.projectPoints(
+        object_points,
+        rvec,
+        tvec,
+        camera_matrix,
+        None,
+    )
+    error = math.sqrt(
+        numpy.square(projected.reshape(-1, 2) - image_points.reshape(-1, 2)).mean()
+    )
+    if error > max(last_error * WARM_START_ERROR_RATIO, WARM_START_MIN_ERROR_PX):
+        return None
+    return rvec.reshape(3), tvec.reshape(3), error
 
 
 class PoseEstimator:
@@ -20,30 +99,131 @@ class PoseEstimator:
     ) -> Union[PoseObservation, None]:
         raise NotImplementedError
 
+    def solve_fiducial_poses(
+        self,
+        image_observations: List[FiducialImageObservation],
+        config_store: ConfigStore,
+    ) -> List[Union[PoseObservation, None]]:
+        return [
+            self.solve_fiducial_pose(image_observation, config_store)
+            for image_observation in image_observations
+        ]
+
 
 class SquareTargetPoseEstimator(PoseEstimator):
     def __init__(self) -> None:
-        pass
+        self._camera_model: Union[CameraModel, None] = None
+        # Solutions from the previous frame by tag ID, as rvecs, tvecs and
+        # errors of both candidates, used to warm start the next solve
+        self._last_solutions: Dict[int, Solution] = {}
+        self._config_version: Union[int, None] = None
 
     def solve_fiducial_pose(
         self, image_observation: FiducialImageObservation, config_store: ConfigStore
     ) -> Union[PoseObservation, None]:
-        fid_size = config_store.remote_config.fiducial_size_m
-        object_points = numpy.array(
-            [
-                [-fid_size / 2.0, fid_size / 2.0, 0.0],
-                [fid_size / 2.0, fid_size / 2.0, 0.0],
-                [fid_size / 2.0, -fid_size / 2.0, 0.0],
-                [-fid_size / 2.0, -fid_size / 2.0, 0.0],
-            ]
+        self._camera_model = update_camera_model(self._camera_model, config_store)
+        try:
+            corners = self._camera_model.undistort(image_observation.corners)
+        except Exception as e:
+            print(e)
+            return None
+        solution = self._solve_cold(
+            corners,
+            square_object_points(config_store.remote_config.fiducial_size_m),
+            self._camera_model.camera_matrix,
+        )
+        if solution is None:
+            return None
+        return PoseObservation(
+            [image_observation.tag_id],
+            False,
+            openCvPosesToWpilib(solution[1], solution[0]),
+            solution[2],
         )
 
+    def solve_fiducial_poses(
+        self,
+        image_observations: List[FiducialImageObservation],
+        config_store: ConfigStore,
+    ) -> List[Union[PoseObservation, None]]:
+        """Solve every observation in a frame.
+
+        All corners are undistorted together, after which every solve is
+        pinhole-only. Every tag is solved from scratch. With
+        pose_warm_start, the best pose of tags solved in the previous call is
+        then refined from their last solution.
+        """
+        if config_store.version != self._config_version:
+            self._config_version = config_store.version
+            self._last_solutions = {}
+        self._camera_model = update_camera_model(self._camera_model, config_store)
+        camera_matrix = self._camera_model.camera_matrix
+        object_points = square_object_points(config_store.remote_config.fiducial_size_m)
+        if len(image_observations) == 0:
+            return []
+        try:
+            corners = self._camera_model.undistort(
+                numpy.array([x.corners.reshape(4, 2) for x in image_observations])
+            )
+        except Exception as e:
+            print(e)
+            return [None] * len(image_observations)
+
+        solutions: List[Union[Solution, None]] = [None] * len(image_observations)
+        for i, image_observation in enumerate(image_observations):
+            solutions[i] = self._solve_cold(corners[i], object_points, camera_matrix)
+            last_solution = self._last_solutions.get(image_observation.tag_id)
+            if (
+                config_store.local_config.pose_warm_start
+                and solutions[i] is not None
+                and last_solution is not None
+            ):
+                solutions[i] = self._solve_warm(
+                    corners[i],
+                    object_points,
+                    solutions[i],
+                    last_solution,
+                    camera_matrix,
+                )
+
+        if config_store.local_config.pose_warm_start:
+            self._last_solutions = {
+                image_observation.tag_id: solution
+                for image_observation, solution in zip(image_observations, solutions)
+                if solution is not None
+            }
+
+        # Convert all poses to WPILib at once
+        solved = [solution for solution in solutions if solution is not None]
+        poses = iter(
+            openCvPosesToWpilib(
+                numpy.array([solution[1] for solution in solved]),
+                numpy.array([solution[0] for solution in solved]),
+            ).reshape(-1, 2, 7)
+        )
+        return [
+            (
+                None
+                if solution is None
+                else PoseObservation(
+                    [image_observation.tag_id], False, next(poses), solution[2]
+                )
+            )
+            for image_observation, solution in zip(image_observations, solutions)
+        ]
+
+    def _solve_cold(
+        self,
+        corners: numpy.typing.NDArray[numpy.float64],
+        object_points: numpy.typing.NDArray[numpy.float64],
+        camera_matrix: numpy.typing.NDArray[numpy.float64],
+    ) -> Union[Solution, None]:
         try:
             _, rvecs, tvecs, errors = cv2.solvePnPGeneric(
                 object_points,
-                image_observation.corners,
-                config_store.local_config.camera_matrix,
-                config_store.local_config.distortion_coefficients,
+                corners,
+                camera_matrix,
+                None,
                 flags=cv2.SOLVEPNP_IPPE_SQUARE,
             )
         except Exception as e:
@@ -51,11 +231,54 @@ class SquareTargetPoseEstimator(PoseEstimator):
             return None
         if len(rvecs) == 0 or len(tvecs) == 0:
             return None
-        return PoseObservation(
-            [image_observation.tag_id],
-            False,
-            openCvPoseToWpilib(tvecs[0], rvecs[0]),
-            errors[0][0],
-            openCvPoseToWpilib(tvecs[1], rvecs[1]),
-            errors[1][0],
+        return (
+            numpy.array(rvecs).reshape(2, 3),
+            numpy.array(tvecs).reshape(2, 3),
+            errors.reshape(2),
+        )
+
+    def _solve_warm(
+        self,
+        corners: numpy.typing.NDArray[numpy.float64],
+        object_points: numpy.typing.NDArray[numpy.float64],
+        cold_solution: Solution,
+        last_solution: Solution,
+        camera_matrix: numpy.typing.NDArray[numpy.float64],
+    ) -> Solution:
+        """Refine the best candidate from the previous frame, keeping the cold
+        candidate furthest from it as the alternate, or return the cold
+        solution if the refined pose no longer fits.
+
+        Only the best candidate is refined because LM refinement of the
+        ambiguous candidate converges onto the best one, which would report
+        two identical poses for every tag from then on.
+        """
+        refined = refine_pose(
+            object_points,
+            corners,
+            last_solution[0][0],
+            last_solution[1][0],
+            last_solution[2][0],
+            camera_matrix,
+        )
+        if refined is None:
+            return cold_solution
+        rvec, tvec, error = refined
+
+        # The candidate whose rotation is furthest from the refined pose has
+        # the smallest trace of the relative rotation
+        refined_rotation, _ = cv2.Rodrigues(rvec)
+        alternate = int(
+            numpy.argmin(
+                [
+                    numpy.trace(refined_rotation.T @ cv2.Rodrigues(cold_rvec)[0])
+                    for cold_rvec in cold_solution[0]
+                ]
+            )
         )
+        rvecs = numpy.array([rvec, cold_solution[0][alternate]])
+        tvecs = numpy.array([tvec, cold_solution[1][alternate]])
+        errors = numpy.array([error, cold_solution[2][alternate]])
+        if errors[1] < errors[0]:
+            return rvecs[::-1], tvecs[::-1], errors[::-1]
+        return rvecs, tvecs, errors
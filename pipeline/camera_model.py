@@ -0,0 +1,52 @@
+from typing import Union
+
+import cv2
+import numpy
+import numpy.typing
+from config.config import ConfigStore
+
+
+class CameraModel:
+    """Camera calibration used to remove lens distortion from all corners of
+    a frame at once.
+
+    Corners are undistorted to ideal pinhole pixel coordinates, so solvers only
+    need the camera matrix and reprojection errors are still in pixels.
+    """
+
+    def __init__(
+        self,
+        camera_matrix: numpy.typing.NDArray[numpy.float64],
+        distortion_coefficients: numpy.typing.NDArray[numpy.float64],
+    ) -> None:
+        self.camera_matrix = camera_matrix
+        self.distortion_coefficients = distortion_coefficients
+
+    def undistort(
+        self, points: numpy.typing.NDArray[numpy.float64]
+    ) -> numpy.typing.NDArray[numpy.float64]:
+        """Undistort pixel coordinates of any shape (..., 2) in one call."""
+        points = numpy.asarray(points, dtype=numpy.float64)
+        return cv2.undistortPoints(
+            points.reshape(-1, 1, 2),
+            self.camera_matrix,
+            self.distortion_coefficients,
+            P=self.camera_matrix,
+        ).reshape(points.shape)
+
+
+def update_camera_model(
+    camera_model: Union[CameraModel, None], config_store: ConfigStore
+) -> CameraModel:
+    """Return camera_model, or a new model if the calibration has changed."""
+    local_config = config_store.local_config
+    if (
+        camera_model is None
+        or camera_model.camera_matrix is not local_config.camera_matrix
+        or camera_model.distortion_coefficients
+        is not local_config.distortion_coefficients
+    ):
+        return CameraModel(
+            local_config.camera_matrix, local_config.distortion_coefficients
+        )
+    return camera_model
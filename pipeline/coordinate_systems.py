@@ -1,25 +1,38 @@
 from typing import List
 import numpy
-from wpimath.geometry import Translation3d, Rotation3d, Pose3d
+from wpimath.geometry import Translation3d, Rotation3d, Pose3d, Quaternion
 import numpy.typing
-import math
-
-
-def openCvPoseToWpilib(
-    tvec: numpy.typing.NDArray[numpy.float64], rvec: numpy.typing.NDArray[numpy.float64]
-) -> Pose3d:
-    return Pose3d(
-        Translation3d(tvec[2][0], -tvec[0][0], -tvec[1][0]),
-        Rotation3d(
-            numpy.array([rvec[2][0], -rvec[0][0], -rvec[1][0]]),
-            math.sqrt(
-                math.pow(rvec[0][0], 2)
-                + math.pow(rvec[1][0], 2)
-                + math.pow(rvec[2][0], 2)
-            ),
-        ),
-    )
 
 
 def wpilibTranslationToOpenCv(translation: Translation3d) -> List[float]:
     return [-translation.Y(), -translation.Z(), translation.X()]
+
+
+def openCvPosesToWpilib(
+    tvecs: numpy.typing.NDArray[numpy.float64],
+    rvecs: numpy.typing.NDArray[numpy.float64],
+) -> numpy.typing.NDArray[numpy.float64]:
+    """Convert OpenCV poses with tvecs and rvecs of shape (N, 3) to rows of
+    (x, y, z, qw, qx, qy, qz) in WPILib coordinates."""
+    tvecs = numpy.asarray(tvecs, dtype=numpy.float64).reshape(-1, 3)
+    rvecs = numpy.asarray(rvecs, dtype=numpy.float64).reshape(-1, 3)
+    angles = numpy.sqrt(numpy.square(rvecs).sum(axis=1))
+    sin_scale = numpy.full(angles.shape, 0.5)
+    numpy.divide(numpy.sin(angles / 2), angles, out=sin_scale, where=angles > 1e-12)
+    poses = numpy.empty((tvecs.shape[0], 7))
+    poses[:, 0] = tvecs[:, 2]
+    poses[:, 1] = -tvecs[:, 0]
+    poses[:, 2] = -tvecs[:, 1]
+    poses[:, 3] = numpy.cos(angles / 2)
+    poses[:, 4] = rvecs[:, 2] * sin_scale
+    poses[:, 5] = -rvecs[:, 0] * sin_scale
+    poses[:, 6] = -rvecs[:, 1] * sin_scale
+    return poses
+
+
+def wpilibPoseFromArray(pose: numpy.typing.NDArray[numpy.float64]) -> Pose3d:
+    """Build a Pose3d from a row of (x, y, z, qw, qx, qy, qz)."""
+    return Pose3d(
+        Translation3d(pose[0], pose[1], pose[2]),
+        Rotation3d(Quaternion(pose[3], pose[4], pose[5], pose[6])),
+    )
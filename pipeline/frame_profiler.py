@@ -0,0 +1,79 @@
+import concurrent.futures
+import cProfile
+import io
+import pstats
+import threading
+import time
+from typing import Union
+
+
+class FrameProfiler:
+    """Profiles frame processing for a while when requested from another
+    thread, without restarting the process.
+
+    The pipeline wraps each frame in start_frame and end_frame. Frames may be
+    processed on different threads, so the profiler is only enabled around
+    each frame rather than for the whole thread.
+    """
+
+    # Number of functions included in the report
+    REPORT_LENGTH = 60
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._future: Union[concurrent.futures.Future, None] = None
+        self._seconds = 0.0
+        # Only used by the thread processing a frame
+        self._profile: Union[cProfile.Profile, None] = None
+        self._profile_future: Union[concurrent.futures.Future, None] = None
+        self._end_time = 0.0
+
+    def request(self, seconds: float) -> Union[concurrent.futures.Future, None]:
+        """Profile frames for a number of seconds, starting with the next frame.
+
+        Returns a future of the report as text, or None if a profile is
+        already running. Cancelling the future, for example when the
+        requester times out, abandons the profile.
+        """
+        with self._lock:
+            if self._future is not None and not self._future.cancelled():
+                return None
+            self._future = concurrent.futures.Future()
+            self._seconds = seconds
+            return self._future
+
+    def start_frame(self) -> None:
+        with self._lock:
+            future = self._future
+            seconds = self._seconds
+        if future is None or future.cancelled():
+            return
+        if self._profile_future is not future:
+            self._profile = cProfile.Profile()
+            self._profile_future = future
+            self._end_time = time.monotonic() + seconds
+        self._profile.enable()
+
+    def end_frame(self) -> None:
+        profile = self._profile
+        future = self._profile_future
+        if profile is None or future is None:
+            return
+        profile.disable()
+        # The request may have been cancelled, for example by a timeout
+        cancelled = future.cancelled()
+        if not cancelled and time.monotonic() < self._end_time:
+            return
+
+        self._profile = None
+        self._profile_future = None
+        with self._lock:
+            if self._future is future:
+                self._future = None
+        if cancelled:
+            return
+        report = io.StringIO()
+        stats = pstats.Stats(profile, stream=report)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(self.REPORT_LENGTH)
+        if future.set_running_or_notify_cancel():
+            future.set_result(report.getvalue())
@@ -0,0 +1,81 @@
+import bisect
+import collections
+import time
+from typing import Deque, Dict, List, Tuple
+
+import numpy
+
+# Upper bounds in seconds of the buckets counted by StageTimer.get_histograms
+HISTOGRAM_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+class StageTimer:
+    """Rolling latency of each stage of frame processing, and histograms of
+    all frames since start.
+
+    Stages are timed by calling mark with the name of the stage that just
+    finished. A stage marked several times in one frame is recorded as the sum
+    of its intervals, and stages not reached in a frame are not recorded.
+    """
+
+    def __init__(self, window: int = 300) -> None:
+        self._window = window
+        self._samples: Dict[str, Deque[float]] = {}
+        # Count of each bucket plus one above the last, and the sum of times
+        self._bucket_counts: Dict[str, List[int]] = {}
+        self._sums: Dict[str, float] = {}
+        self._frame_times: Dict[str, float] = {}
+        self._frame_start = 0.0
+        self._last_mark = 0.0
+
+    def start_frame(self) -> None:
+        self._frame_times = {}
+        self._frame_start = time.perf_counter()
+        self._last_mark = self._frame_start
+
+    def mark(self, stage: str) -> None:
+        """Add the time since the previous mark to stage."""
+        now = time.perf_counter()
+        self._frame_times[stage] = (
+            self._frame_times.get(stage, 0.0) + now - self._last_mark
+        )
+        self._last_mark = now
+
+    def end_frame(self) -> None:
+        """Record the times of the current frame, including its total."""
+        self._frame_times["total"] = self._last_mark - self._frame_start
+        for stage, duration in self._frame_times.items():
+            if stage not in self._samples:
+                self._samples[stage] = collections.deque(maxlen=self._window)
+                self._sums[stage] = 0.0
+                self._bucket_counts[stage] = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+            self._samples[stage].append(duration)
+            self._bucket_counts[stage][
+                bisect.bisect_left(HISTOGRAM_BUCKETS, duration)
+            ] += 1
+            self._sums[stage] += duration
+
+    def get_stats(self) -> Dict[str, Tuple[float, float, float]]:
+        """Return the p50, p95 and max of each stage in milliseconds."""
+        stats = {}
+        for stage, samples in self._samples.items():
+            times = numpy.array(samples) * 1000.0
+            p50, p95 = numpy.percentile(times, (50, 95))
+            stats[stage] = (float(p50), float(p95), float(times.max()))
+        return stats
+
+    def get_histograms(self) -> Dict[str, Tuple[List[int], float]]:
+        """Return the cumulative count of frames in each of HISTOGRAM_BUCKETS
+        plus the total count, and the sum of times in seconds, of each stage.
+
+        Safe to call from another thread, at worst missing the current frame.
+        """
+        histograms = {}
+        for stage, bucket_counts in list(self._bucket_counts.items()):
+            cumulative_counts = []
+            count = 0
+            for bucket_count in list(bucket_counts):
+                count += bucket_count
+                cumulative_counts.append(count)
+            histograms[stage] = (cumulative_counts, self._sums[stage])
+        return histograms
@@ -0,0 +1,28 @@
+import fcntl
+import os
+import struct
+from typing import List, Tuple
+
+# Control IDs from linux/v4l2-controls.h
+V4L2_CID_GAIN = 0x00980913
+V4L2_CID_EXPOSURE_AUTO = 0x009A0901
+V4L2_CID_EXPOSURE_ABSOLUTE = 0x009A0902
+
+# enum v4l2_exposure_auto_type
+V4L2_EXPOSURE_MANUAL = 1
+
+# _IOWR("V", 28, struct v4l2_control) from linux/videodev2.h
+VIDIOC_S_CTRL = 0xC008561C
+
+
+def set_controls(device: str, controls: List[Tuple[int, int]]) -> None:
+    """Set V4L2 controls on a device, in order, while it may be streaming.
+
+    Raises OSError if the device cannot be opened or a control is rejected.
+    """
+    fd = os.open(device, os.O_RDWR | os.O_NONBLOCK)
+    try:
+        for control_id, value in controls:
+            fcntl.ioctl(fd, VIDIOC_S_CTRL, struct.pack("Ii", control_id, value))
+    finally:
+        os.close(fd)
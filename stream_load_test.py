@@ -0,0 +1,115 @@
+import argparse
+import http.client
+import socket
+import threading
+import time
+from typing import List
+
+import ntcore
+
+from config.config import ConfigStore, LocalConfig, RemoteConfig
+from config.ConfigSource import FileConfigSource
+from pipeline.CameraPipeline import CameraPipeline
+from pipeline.Capture import ReplayCapture
+
+
+class StreamClient:
+    """Reads the MJPEG stream on a background thread, counting frames."""
+
+    def __init__(self, port: int) -> None:
+        self.frames = 0
+        self._running = True
+        self._connection = http.client.HTTPConnection("localhost", port, timeout=5)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        self._connection.request("GET", "/stream.mjpg")
+        response = self._connection.getresponse()
+        # Keep the end of the last chunk in case a boundary is split
+        tail = b""
+        try:
+            while self._running:
+                chunk = response.read1(65536)
+                if len(chunk) == 0:
+                    break
+                data = tail + chunk
+                self.frames += data.count(b"--FRAME")
+                tail = data[-6:]
+        except OSError:
+            pass
+
+    def stop(self) -> None:
+        self._running = False
+        # Unblock the read
+        if self._connection.sock is not None:
+            self._connection.sock.shutdown(socket.SHUT_RDWR)
+        self._thread.join(timeout=5)
+        self._connection.close()
+
+
+def measure_fps(pipeline: CameraPipeline, seconds: float) -> float:
+    """Process frames for a number of seconds and return the frame rate."""
+    frames = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        if not pipeline.process_frame():
+            break
+        frames += 1
+    return frames / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the pipeline frame rate with stream clients connected."
+    )
+    parser.add_argument("--config", default=FileConfigSource.CONFIG_FILENAME)
+    parser.add_argument("--calibration", default=FileConfigSource.CALIBRATION_FILENAME)
+    parser.add_argument("--input", required=True, help="Video file or image directory")
+    parser.add_argument(
+        "--clients",
+        type=int,
+        nargs="+",
+        default=[0, 1, 2, 4, 8],
+        help="Numbers of stream clients to test",
+    )
+    parser.add_argument("--seconds", type=float, default=10.0)
+    args = parser.parse_args()
+
+    # Keep NetworkTables local so nothing is published to a robot
+    ntcore.NetworkTableInstance.getDefault().startLocal()
+    config_source = FileConfigSource(args.config, args.calibration)
+    config = config_source.update(ConfigStore(LocalConfig(), RemoteConfig()))
+    pipeline = CameraPipeline(
+        config,
+        ReplayCapture(args.input, 0, True),
+        config_source.calibration_filename,
+    )
+    pipeline.start()
+    port = config.local_config.stream_port
+
+    # Warm up before measuring
+    measure_fps(pipeline, 1.0)
+    print(f"{'clients':>7} {'pipeline fps':>12} {'stream fps':>10}")
+    baseline = None
+    for count in args.clients:
+        clients: List[StreamClient] = [StreamClient(port) for _ in range(count)]
+        fps = measure_fps(pipeline, args.seconds)
+        for client in clients:
+            client.stop()
+        stream_fps = (
+            sum(client.frames for client in clients) / count / args.seconds
+            if count > 0
+            else 0.0
+        )
+        if baseline is None:
+            baseline = fps
+        print(
+            f"{count:>7} {fps:>12.1f} {stream_fps:>10.1f}"
+            + f" ({(fps / baseline - 1) * 100:+.0f}%)"
+        )
+    pipeline.stop()
+
+
+if __name__ == "__main__":
+    main()
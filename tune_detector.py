@@ -0,0 +1,146 @@
+import argparse
+import itertools
+import json
+import time
+from typing import Any, Dict, List, Set
+
+import cv2
+import numpy
+
+from config.config import ConfigStore, LocalConfig, RemoteConfig
+from pipeline.Capture import ReplayCapture
+from pipeline.FiducialDetector import DETECTOR_PROFILES, make_detector_parameters
+
+# Parameter values swept in addition to the named profiles
+SWEEP = {
+    "adaptiveThreshWinSizeMin": [3, 7, 13],
+    "adaptiveThreshWinSizeMax": [7, 13, 23],
+    "adaptiveThreshWinSizeStep": [4, 10],
+    "minMarkerPerimeterRate": [0.01, 0.03, 0.05],
+    "cornerRefinementMethod": [
+        cv2.aruco.CORNER_REFINE_NONE,
+        cv2.aruco.CORNER_REFINE_SUBPIX,
+    ],
+}
+
+
+def load_frames(path: str, max_frames: int) -> List[cv2.Mat]:
+    """Read grayscale frames from a recording supported by ReplayCapture."""
+    config_store = ConfigStore(LocalConfig(grayscale_capture=True), RemoteConfig())
+    capture = ReplayCapture(path, 0)
+    frames = []
+    while len(frames) < max_frames:
+        success, image, _ = capture.get_frame(config_store)
+        if not success:
+            break
+        frames.append(image)
+    capture.stop()
+    return frames
+
+
+def sweep_profiles() -> Dict[str, Dict[str, Any]]:
+    """Return the named profiles plus every valid combination of SWEEP."""
+    profiles = dict(DETECTOR_PROFILES)
+    names = list(SWEEP.keys())
+    for values in itertools.product(*[SWEEP[x] for x in names]):
+        profile = dict(zip(names, values))
+        if profile["adaptiveThreshWinSizeMax"] < profile["adaptiveThreshWinSizeMin"]:
+            continue
+        profiles["sweep_" + str(len(profiles))] = profile
+    return profiles
+
+
+def run_profile(
+    profile: Dict[str, Any], dictionary: cv2.aruco.Dictionary, frames: List[cv2.Mat]
+):
+    """Return the detected tag IDs and detection time in seconds per frame."""
+    detector = cv2.aruco.ArucoDetector(dictionary, make_detector_parameters(profile))
+    detections: List[Set[int]] = []
+    latencies: List[float] = []
+    for frame in frames:
+        start = time.perf_counter()
+        _, ids, _ = detector.detectMarkers(frame)
+        latencies.append(time.perf_counter() - start)
+        detections.append(set() if ids is None else set(ids.flatten().tolist()))
+    return detections, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare detector parameters by latency and recall."
+    )
+    parser.add_argument("--input", required=True, help="Video file or image directory")
+    parser.add_argument("--dictionary", "-d", default="DICT_APRILTAG_36H11")
+    parser.add_argument("--max-frames", type=int, default=300)
+    parser.add_argument(
+        "--min-recall",
+        type=float,
+        default=0.99,
+        help="Recall required for a profile to be recommended",
+    )
+    parser.add_argument(
+        "--named-only", action="store_true", help="Only compare the named profiles"
+    )
+    parser.add_argument("--output", help="Write all results to a JSON file")
+    args = parser.parse_args()
+
+    dictionary = cv2.aruco.getPredefinedDictionary(getattr(cv2.aruco, args.dictionary))
+    frames = load_frames(args.input, args.max_frames)
+    if len(frames) == 0:
+        print("No frames found in", args.input)
+        return
+    profiles = dict(DETECTOR_PROFILES) if args.named_only else sweep_profiles()
+    print("Testing", len(profiles), "profiles on", len(frames), "frames")
+
+    # Detections of every profile, the union of which is treated as ground truth
+    all_detections = {}
+    all_latencies = {}
+    for name, profile in profiles.items():
+        all_detections[name], all_latencies[name] = run_profile(
+            profile, dictionary, frames
+        )
+    reference = [
+        set().union(*[all_detections[name][i] for name in profiles])
+        for i in range(len(frames))
+    ]
+    reference_count = sum(len(x) for x in reference)
+
+    results = []
+    for name, profile in profiles.items():
+        found = sum(
+            len(detections & expected)
+            for detections, expected in zip(all_detections[name], reference)
+        )
+        latencies = numpy.array(all_latencies[name]) * 1000
+        results.append(
+            {
+                "name": name,
+                "profile": profile,
+                "recall": found / reference_count if reference_count > 0 else 1.0,
+                "mean_ms": float(latencies.mean()),
+                "p95_ms": float(numpy.percentile(latencies, 95)),
+            }
+        )
+    results.sort(key=lambda x: x["mean_ms"])
+
+    print(f"{'name':<12} {'recall':>7} {'mean ms':>8} {'p95 ms':>8}")
+    for result in results:
+        print(
+            f"{result['name']:<12} {result['recall']:>7.3f}"
+            + f" {result['mean_ms']:>8.2f} {result['p95_ms']:>8.2f}"
+        )
+
+    recommended = [x for x in results if x["recall"] >= args.min_recall]
+    if len(recommended) > 0:
+        print("Fastest profile with recall >=", args.min_recall)
+        print(json.dumps(recommended[0], indent=4))
+    else:
+        print("No profile reached a recall of", args.min_recall)
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
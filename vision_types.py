@@ -5,6 +5,8 @@ import numpy
 import numpy.typing
 from wpimath.geometry import Pose3d
 
+from pipeline.coordinate_systems import wpilibPoseFromArray
+
 
 @dataclass(frozen=True)
 class FiducialImageObservation:
@@ -14,9 +16,26 @@ class FiducialImageObservation:
 
 @dataclass(frozen=True)
 class PoseObservation:
+    """One or two candidate poses as rows of (x, y, z, qw, qx, qy, qz) in WPILib
+    coordinates, with the reprojection error of each row."""
+
     tag_ids: List[int]
     multitag: bool
-    pose_0: Pose3d
-    error_0: float
-    pose_1: Union[Pose3d, None]
-    error_1: Union[float, None]
+    poses: numpy.typing.NDArray[numpy.float64]
+    errors: numpy.typing.NDArray[numpy.float64]
+
+    @property
+    def pose_0(self) -> Pose3d:
+        return wpilibPoseFromArray(self.poses[0])
+
+    @property
+    def error_0(self) -> float:
+        return float(self.errors[0])
+
+    @property
+    def pose_1(self) -> Union[Pose3d, None]:
+        return wpilibPoseFromArray(self.poses[1]) if len(self.poses) > 1 else None
+
+    @property
+    def error_1(self) -> Union[float, None]:
+        return float(self.errors[1]) if len(self.errors) > 1 else None